@@ -1,110 +1,273 @@
-from time import sleep
+from functools import partial
 
 from proxmoxer import ProxmoxAPI
 
-from .model import Host, VM
-from .algorithm import calculate_migrations
+from .algorithm import get_engine, measure_imbalance
+from .executor import (
+    DEFAULT_BANDWIDTH,
+    BandwidthEstimate,
+    MigrationLimits,
+    execute_migrations,
+)
+from .compact import compact_migrations
+from .cost import migration_bytes
+from .history import add_memory_history
+from .inventory import add_local_disks, get_inventory
+from .localsearch import improve_migrations
+from .metrics import Metrics
+from .plancache import PlanCache, fingerprint
+from .replan import Replanner
+from .scheduler import log_schedule, schedule_migrations
+from .snapshot import read_snapshot, write_snapshot
 from .helper import get_logger
 
 
 logger = get_logger(__name__)
 
 
-def hosts_in_migrations(migrations):
-    yield from (migration.vm.host for migration in migrations)
-    yield from (migration.target_host for migration in migrations)
+def connect(pve_config, timeout=None):
+    if timeout is not None:
+        pve_config = dict(pve_config, timeout=timeout)
+    return ProxmoxAPI(**pve_config)
 
 
-def wait_for_tasks(proxmox, running):
-    logger.info(
-        "Waiting for completion of {} tasks",
-        len(running),
+def calculate(hosts, exclude, engine="reference", cost=None, cpu_weight=0,
+              time_budget=0, stats=None, metrics=None, threshold=1024**3,
+              compact_tolerance=0):
+    """
+    Calculates the migrations with the engine, balancing the hosts down to
+    the threshold. Given a `time_budget` in seconds, they are improved by a
+    local search afterwards. Given a `compact_tolerance` in bytes, chained
+    and cancelling migrations of VMs differing by up to that much are
+    compacted last.
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    calculate_migrations = get_engine(engine)
+    logger.debug("Starting to calculate migrations")
+    with metrics.phase("planning"):
+        migrations = calculate_migrations(
+            hosts, exclude, threshold, stats=stats, cost=cost,
+            cpu_weight=cpu_weight,
+        )
+
+    if time_budget:
+        with metrics.phase("local_search"):
+            migrations = improve_migrations(
+                hosts, exclude, migrations, threshold, time_budget,
+                cpu_weight=cpu_weight, stats=stats,
+            )
+
+    if compact_tolerance:
+        with metrics.phase("compaction"):
+            migrations = compact_migrations(
+                hosts, exclude, migrations, compact_tolerance, cpu_weight,
+                stats,
+            )
+
+    return migrations
+
+
+def plan(hosts, exclude, engine="reference", cost=None, cpu_weight=0,
+         limits=MigrationLimits(), estimate=None, metrics=None,
+         time_budget=0, compact_tolerance=0):
+    """
+    Calculates the migrations and returns them in the order to execute them
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    migrations = calculate(
+        hosts, exclude, engine, cost, cpu_weight, time_budget,
+        metrics.planner, metrics, compact_tolerance=compact_tolerance,
     )
+    return schedule(migrations, limits, estimate, metrics)
 
-    num_running = len(running)
-    while len(running) == num_running:
-        for task in proxmox.cluster.tasks.get():
-            if "endtime" in task:
-                try:
-                    del running[task["upid"]]
-                except KeyError:
-                    pass
-        if len(running) == num_running:
-            sleep(1)
-
-
-def balance(pve_config, dry=False, wait=False, exclude_names=[]):
-    proxmox = ProxmoxAPI(**pve_config)
-
-    hosts = []
-    exclude = []
-
-    for node in proxmox.nodes.get():
-        vms = []
-        for vm in proxmox.nodes(node["node"]).qemu.get(full=1):
-            if vm["status"] != "running":
-                continue
-
-            vms.append(VM(
-                id=vm["vmid"],
-                used_memory=vm["mem"],
-                total_memory=vm["maxmem"],
-                host=node["node"],
-            ))
-        hosts.append(Host(
-            name=node["node"],
-            used_memory=node["mem"],
-            total_memory=node["maxmem"],
-            vms=vms,
-        ))
-        if node["node"] in exclude_names:
-            exclude.append(hosts[-1])
 
-    logger.debug("Starting to calculate migrations")
-    migrations = calculate_migrations(hosts, exclude)
-
-    if dry:
-        logger.info("Terminating due to dry mode.")
-        return
-
-    running = {}
-    while migrations:
-        migrating_hosts = set(hosts_in_migrations(running.values()))
-        for i, migration in enumerate(migrations):
-            busy_hosts = \
-                {migration.vm.host, migration.target_host} & migrating_hosts
-            if busy_hosts:
-                logger.debug(
-                    "Postponing migration of VM {0.vm.id} , because {1} is "
-                    "busy",
-                    migration,
-                    tuple(busy_hosts)[0],
+def schedule(migrations, limits=MigrationLimits(), estimate=None,
+             metrics=None):
+    """
+    Returns the migrations in the order to execute them and logs their
+    predicted total duration
+    """
+    if metrics is None:
+        metrics = Metrics()
+
+    with metrics.phase("scheduling"):
+        migrations, makespan = schedule_migrations(
+            migrations, limits, estimate,
+        )
+    log_schedule(migrations, makespan)
+    return migrations
+
+
+def plan_snapshot(path, exclude_names=[], engine="reference",
+                  limits=MigrationLimits(), bandwidth=DEFAULT_BANDWIDTH,
+                  minimize="migrations", cpu_weight=0, time_budget=0,
+                  compact_tolerance=0):
+    """
+    Plans the migrations for a recorded snapshot of a cluster, without
+    connecting to it
+    """
+    hosts, exclude = read_snapshot(path)
+    exclude.extend(
+        host for host in hosts
+        if host.name in exclude_names and host not in exclude
+    )
+    metrics = Metrics()
+    migrations = plan(
+        hosts,
+        exclude,
+        engine,
+        migration_bytes if minimize == "bytes" else None,
+        cpu_weight,
+        limits,
+        BandwidthEstimate(bandwidth),
+        metrics,
+        time_budget,
+        compact_tolerance,
+    )
+    logger.info("Metrics of this run: {}", metrics.to_json())
+    return migrations
+
+
+def balance(pve_config, dry=False, wait=False, exclude_names=[],
+            engine="reference", inventory="resources", concurrency=8,
+            timeout=None, limits=MigrationLimits(),
+            bandwidth=DEFAULT_BANDWIDTH, minimize="migrations",
+            cpu_weight=0, memory="current", window=24 * 3600,
+            rrd_cache=None, proxmox=None, trigger=None, estimate=None,
+            disk_sizes=None, stop=None, replan=True, record=None,
+            metrics_textfile=None, time_budget=0, plan_cache=None,
+            plan_cache_entries=32, plan_cache_age=3600, compact_tolerance=0):
+    """
+    Balances the cluster once. To balance it repeatedly, pass the API
+    session as `proxmox`, a persistent `estimate` of the bandwidth and dict
+    of `disk_sizes`, so they are reused. With a `trigger`, migrations are
+    only planned if the imbalance exceeds it. Unless `replan` is false, the
+    remaining migrations are replanned if the cluster drifts meanwhile.
+    The inventory migrations are planned for is written to the snapshot file
+    `record`, if given.
+
+    The metrics of the run are logged as JSON at the end and written to the
+    Prometheus textfile `metrics_textfile`, if given. Given a `time_budget`
+    in seconds, the planned migrations are improved by a local search, and
+    given a `compact_tolerance` in bytes, they are compacted.
+
+    If a `plan_cache` path is given, plans are cached there by a fingerprint
+    of the inventory and options, for up to `plan_cache_age` seconds and
+    `plan_cache_entries` plans. A cached plan is reused instead of planning
+    again, and nothing is done at all if it contains no migrations.
+    """
+    metrics = Metrics()
+    try:
+        # Fail early on an unknown engine
+        get_engine(engine)
+        if proxmox is None:
+            with metrics.phase("connect"):
+                proxmox = connect(pve_config, timeout)
+        metrics.count_requests(proxmox)
+
+        with metrics.phase("inventory"):
+            hosts = get_inventory(proxmox, inventory, concurrency)
+        with metrics.phase("history"):
+            add_memory_history(
+                proxmox, hosts, memory, window, rrd_cache, concurrency,
+            )
+        exclude = [host for host in hosts if host.name in exclude_names]
+
+        if trigger is not None:
+            imbalance = measure_imbalance(hosts, exclude, cpu_weight)
+            if imbalance <= trigger:
+                logger.info(
+                    "Imbalance of {!b} doesn't exceed {!b}, nothing to do",
+                    imbalance,
+                    trigger,
+                )
+                return
+
+        cost = None
+        if minimize == "bytes":
+            # Before the fingerprint, so changed disks invalidate cached plans
+            with metrics.phase("local_disks"):
+                add_local_disks(proxmox, hosts, concurrency, disk_sizes)
+            cost = migration_bytes
+
+        cache = migrations = None
+        if plan_cache:
+            with metrics.phase("plan_cache"):
+                cache = PlanCache.load(
+                    plan_cache, plan_cache_entries, plan_cache_age,
+                )
+                key = fingerprint(
+                    hosts, exclude, cpu_weight=cpu_weight, engine=engine,
+                    minimize=minimize, limits=limits, time_budget=time_budget,
+                    compact_tolerance=compact_tolerance,
                 )
-                continue
+                migrations = cache.get(key, hosts)
+
+        if record is not None:
+            write_snapshot(record, hosts, exclude)
 
+        if estimate is None:
+            estimate = BandwidthEstimate(bandwidth)
+        if migrations is None:
+            migrations = plan(
+                hosts, exclude, engine, cost, cpu_weight, limits, estimate,
+                metrics, time_budget, compact_tolerance,
+            )
+            if cache is not None:
+                cache.put(key, migrations)
+                cache.save()
+        else:
             logger.info(
-                "Migrating VM {0.vm.id} ({0.vm.used_memory!b}) from host "
-                "{0.vm.host} to host {0.target_host}.",
-                migration,
+                "Cluster unchanged since planning, reusing the cached plan "
+                "of {} migrations",
+                len(migrations),
             )
+            # Keep the plan's time of use for evicting
+            cache.save()
+            migrations = schedule(migrations, limits, estimate, metrics)
 
-            vm = migration.vm
-            task = proxmox.nodes(vm.host).qemu(vm.id).migrate.post(**{
-                "target": migration.target_host,
-                "online": 1,
-                "with-local-disks": 1,
-            })
-            del vm
-
-            running[task] = migration
-            del migrations[i]
-            break
-        else:
-            # we iterated through the non-empty list of remaining migrations,
-            # meaning that all remaining migrations are currently blocked by
-            # running migrations
-            wait_for_tasks(proxmox, running)
-
-    if wait:
-        while len(running) > 0:
-            wait_for_tasks(proxmox, running)
+        if not migrations:
+            logger.info("Nothing to do")
+            return
+
+        if dry:
+            logger.info("Terminating due to dry mode.")
+            return
+
+        replanner = None
+        if replan:
+            replanner = Replanner(
+                proxmox,
+                hosts,
+                exclude,
+                partial(
+                    calculate, engine=engine, cost=cost,
+                    cpu_weight=cpu_weight, time_budget=time_budget,
+                    compact_tolerance=compact_tolerance,
+                ),
+                limits,
+                estimate,
+                concurrency,
+                refresh_memory=memory == "current",
+            )
+
+        with metrics.phase("execution"):
+            execute_migrations(
+                proxmox, migrations, limits, wait, estimate, stop, replanner,
+                metrics,
+            )
+
+        if wait:
+            logger.info(
+                "Observed migration bandwidth was {!b}/s",
+                estimate.bandwidth,
+            )
+    finally:
+        metrics.close()
+        logger.info("Metrics of this run: {}", metrics.to_json())
+        if metrics_textfile is not None:
+            metrics.write_prometheus(metrics_textfile)
@@ -1,7 +1,14 @@
 import logging
 import logging.config
 
-from . import balance
+from . import balance, plan_snapshot
+from .daemon import run_daemon
+from .executor import DEFAULT_BANDWIDTH, MigrationLimits
+from .algorithm import ENGINES
+from .history import DEFAULT_CACHE, parse_statistic
+from .inventory import METHODS
+from .plancache import DEFAULT_PLAN_CACHE
+from .sweep import format_results, sweep
 
 
 def main():
@@ -21,6 +28,29 @@ def main():
                     "{} is not a valid loglevel".format(level)
                 )
 
+    def migration_limit(value):
+        try:
+            limit = int(value)
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            raise argparse.ArgumentTypeError(
+                "{} is not a valid number of migrations".format(value)
+            )
+        # 0 means unlimited
+        return limit or None
+
+    def memory_statistic(value):
+        try:
+            return parse_statistic(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "{} is not a valid statistic".format(value)
+            )
+
+    def node_list(value):
+        return tuple(node for node in value.split(",") if node)
+
     configpaths = [
         os.path.join(base, 'pve-balance.ini')
         for base in (
@@ -40,7 +70,7 @@ def main():
     parser = argparse.ArgumentParser(
         description="Balance VMs in a Proxmox Virtual Environment cluster."
     )
-    parser.add_argument("host")
+    parser.add_argument("host", nargs="?")
     parser.add_argument(
         "--exclude",
         action="append",
@@ -61,10 +91,273 @@ def main():
         action="store_true",
         help="Wait for all migrations to finish before exiting",
     )
+    parser.add_argument(
+        "--no-replan",
+        dest="replan",
+        action="store_false",
+        default=config.getboolean("balance", "replan", fallback=True),
+        help="""
+            Don't check the hosts of the remaining migrations whenever
+            migrations finished, and don't replan them if the cluster
+            drifted meanwhile
+        """,
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="""
+            Keep running and balance the cluster every interval, waiting for
+            the migrations to finish. Stops on SIGTERM once the running
+            migrations finished.
+        """,
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        metavar="SECONDS",
+        default=config.getfloat("balance", "interval", fallback=300),
+        help="Seconds between balancing runs in daemon mode",
+    )
+    parser.add_argument(
+        "--trigger",
+        type=float,
+        metavar="GIB",
+        default=config.getfloat("balance", "trigger", fallback=2),
+        help="""
+            In daemon mode, only plan migrations once the imbalance exceeds
+            this many GiB, then balance down to 1 GiB
+        """,
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="reference",
+        help="""
+            Planning engine to use. The numpy engine yields the same
+            migrations, but is only faster with --minimize bytes or a
+            --cpu-weight. The drain engine only empties the excluded nodes,
+            in a single pass.
+        """,
+    )
+    parser.add_argument(
+        "--plan-time-budget",
+        type=float,
+        metavar="SECONDS",
+        default=config.getfloat("balance", "plan_time_budget", fallback=0),
+        help="""
+            Improve the planned migrations by exchanging VMs between hosts
+            for up to this many seconds, if the imbalance is still above
+            1 GiB. 0 disables the improvement.
+        """,
+    )
+    parser.add_argument(
+        "--compact-tolerance",
+        type=float,
+        metavar="GIB",
+        default=config.getfloat("balance", "compact_tolerance", fallback=0),
+        help="""
+            Collapse chained migrations and drop cancelling ones of VMs
+            whose memory differs by up to this many GiB, letting hosts stray
+            that far from the plan. 0 disables the compaction.
+        """,
+    )
+    parser.add_argument(
+        "--inventory",
+        choices=METHODS,
+        default="resources",
+        help="""
+            How to list the cluster's nodes and VMs: with a single request
+            of the cluster resources (falling back to the nodes method on
+            errors) or with one request per node.
+        """,
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        metavar="N",
+        default=config.getint("balance", "concurrency", fallback=8),
+        help="Maximum number of concurrent requests to list the VMs of nodes",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        default=config.getfloat("balance", "timeout", fallback=None),
+        help="Timeout of each request to the Proxmox API",
+    )
+    for option, default, help in (
+        ("max_outgoing", "1", "migrations leaving a host"),
+        ("max_incoming", "1", "migrations entering a host"),
+        ("max_per_host", "1", "migrations leaving or entering a host"),
+        ("max_migrations", "0", "migrations in the whole cluster"),
+    ):
+        parser.add_argument(
+            "--" + option.replace("_", "-"),
+            type=migration_limit,
+            metavar="N",
+            default=config.get("balance", option, fallback=default),
+            help="Maximum number of concurrent {}, 0 meaning "
+                 "unlimited".format(help),
+        )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        metavar="MIB_PER_SEC",
+        default=config.getfloat(
+            "balance", "bandwidth",
+            fallback=DEFAULT_BANDWIDTH / 1024 ** 2,
+        ),
+        help="""
+            Expected bandwidth of a migration in MiB/s, used to schedule
+            migrations and predict their duration
+        """,
+    )
+    parser.add_argument(
+        "--minimize",
+        choices=("migrations", "bytes"),
+        default=config.get("balance", "minimize", fallback="migrations"),
+        help="""
+            Whether to plan as few migrations as possible or to transfer as
+            few bytes as possible, taking into account the VMs' disks on
+            local storage and how busy their CPUs are
+        """,
+    )
+    parser.add_argument(
+        "--cpu-weight",
+        type=float,
+        metavar="WEIGHT",
+        default=config.getfloat("balance", "cpu_weight", fallback=0),
+        help="""
+            Balance the CPU usage of hosts as well, weighing the cluster's
+            share of CPU cores this much compared to its share of memory.
+            0 balances memory only.
+        """,
+    )
+    parser.add_argument(
+        "--memory",
+        type=memory_statistic,
+        metavar="STATISTIC",
+        default=config.get("balance", "memory", fallback="current"),
+        help="""
+            Memory usage to balance: the current one, the average or a
+            percentile like p95 over the window, from the RRD data of the
+            nodes and VMs
+        """,
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        metavar="HOURS",
+        default=config.getfloat("balance", "window", fallback=24),
+        help="Window of the average or percentile of memory usage",
+    )
+    parser.add_argument(
+        "--rrd-cache",
+        metavar="PATH",
+        default=config.get("balance", "rrd_cache", fallback=DEFAULT_CACHE),
+        help="""
+            File caching the RRD data between runs, so only new samples are
+            fetched. An empty path disables the cache.
+        """,
+    )
+    parser.add_argument(
+        "--plan-cache",
+        metavar="PATH",
+        default=config.get(
+            "balance", "plan_cache", fallback=DEFAULT_PLAN_CACHE,
+        ),
+        help="""
+            File caching plans by a fingerprint of the inventory and
+            options, so an unchanged cluster isn't planned again. An empty
+            path disables the cache.
+        """,
+    )
+    parser.add_argument(
+        "--plan-cache-entries",
+        type=int,
+        metavar="N",
+        default=config.getint("balance", "plan_cache_entries", fallback=32),
+        help="Maximum number of cached plans",
+    )
+    parser.add_argument(
+        "--plan-cache-age",
+        type=float,
+        metavar="SECONDS",
+        default=config.getfloat("balance", "plan_cache_age", fallback=3600),
+        help="Maximum age of a cached plan to be reused",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="""
+            Write the inventory migrations are planned for to a snapshot
+            file, compressed if its name ends with .gz
+        """,
+    )
+    parser.add_argument(
+        "--from-snapshot",
+        metavar="FILE",
+        help="""
+            Plan migrations for a snapshot file written by --record instead
+            of a cluster, without connecting to it. Implies --dry.
+        """,
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        metavar="PATH",
+        default=config.get("balance", "metrics_textfile", fallback=None),
+        help="""
+            Write the metrics of each run, which are logged as JSON at its
+            end, to a textfile for the Prometheus node exporter
+        """,
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="""
+            Plan every combination of the --sweep-* variants in parallel and
+            print the remaining imbalance, number of migrations, bytes to
+            transfer and predicted duration of each plan. Implies --dry.
+        """,
+    )
+    parser.add_argument(
+        "--sweep-threshold",
+        type=float,
+        nargs="+",
+        metavar="GIB",
+        default=[1],
+        help="Imbalances in GiB to balance the cluster down to",
+    )
+    parser.add_argument(
+        "--sweep-engine",
+        choices=ENGINES,
+        nargs="+",
+        help="Planning engines to compare, by default the --engine",
+    )
+    parser.add_argument(
+        "--sweep-drain",
+        action="append",
+        type=node_list,
+        default=[()],
+        metavar="NODE[,NODE...]",
+        help="""
+            Nodes to drain on top of the excluded ones. Can be given several
+            times, each set is planned besides draining none.
+        """,
+    )
+    parser.add_argument(
+        "--sweep-workers",
+        type=int,
+        metavar="N",
+        help="Number of worker processes, by default one per CPU",
+    )
     parser.add_argument("--loglevel", metavar="LEVEL")
     args = parser.parse_args()
 
-    config["pve"]["host"] = args.host
+    if args.host is None and args.from_snapshot is None:
+        parser.error("the following arguments are required: host")
+    if args.host is not None:
+        config["pve"]["host"] = args.host
 
     if args.loglevel:
         config["handler_console"]["level"] = args.loglevel.upper()
@@ -76,7 +369,81 @@ def main():
         # config file does not configure logging, that's ok
         pass
 
-    balance(config["pve"], wait=args.wait, dry=args.dry, exclude_names=args.exclude)
+    options = dict(
+        dry=args.dry,
+        exclude_names=args.exclude,
+        engine=args.engine,
+        inventory=args.inventory,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        limits=MigrationLimits(
+            outgoing=args.max_outgoing,
+            incoming=args.max_incoming,
+            per_host=args.max_per_host,
+            total=args.max_migrations,
+        ),
+        bandwidth=args.bandwidth * 1024 ** 2,
+        minimize=args.minimize,
+        cpu_weight=args.cpu_weight,
+        memory=args.memory,
+        window=args.window * 3600,
+        rrd_cache=os.path.expanduser(args.rrd_cache) or None,
+        replan=args.replan,
+        record=args.record,
+        metrics_textfile=args.metrics_textfile,
+        time_budget=args.plan_time_budget,
+        plan_cache=os.path.expanduser(args.plan_cache) or None,
+        plan_cache_entries=args.plan_cache_entries,
+        plan_cache_age=args.plan_cache_age,
+        compact_tolerance=args.compact_tolerance * 1024 ** 3,
+    )
+
+    if args.sweep:
+        results = sweep(
+            None if args.from_snapshot else config["pve"],
+            snapshot=args.from_snapshot,
+            exclude_names=args.exclude,
+            thresholds=[
+                threshold * 1024 ** 3 for threshold in args.sweep_threshold
+            ],
+            engines=args.sweep_engine or [args.engine],
+            drain_sets=args.sweep_drain,
+            workers=args.sweep_workers,
+            inventory=args.inventory,
+            concurrency=args.concurrency,
+            timeout=args.timeout,
+            limits=options["limits"],
+            bandwidth=options["bandwidth"],
+            minimize=args.minimize,
+            cpu_weight=args.cpu_weight,
+            memory=args.memory,
+            window=options["window"],
+            rrd_cache=options["rrd_cache"],
+            time_budget=args.plan_time_budget,
+            compact_tolerance=options["compact_tolerance"],
+        )
+        print(format_results(results))
+    elif args.from_snapshot:
+        plan_snapshot(
+            args.from_snapshot,
+            exclude_names=args.exclude,
+            engine=args.engine,
+            limits=options["limits"],
+            bandwidth=options["bandwidth"],
+            minimize=args.minimize,
+            cpu_weight=args.cpu_weight,
+            time_budget=args.plan_time_budget,
+            compact_tolerance=options["compact_tolerance"],
+        )
+    elif args.daemon:
+        run_daemon(
+            config["pve"],
+            interval=args.interval,
+            trigger=args.trigger * 1024 ** 3,
+            **options
+        )
+    else:
+        balance(config["pve"], wait=args.wait, **options)
 
 
 if __name__ == "__main__":
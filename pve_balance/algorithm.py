@@ -1,48 +1,159 @@
-from itertools import product
-from operator import attrgetter
+from collections import Counter
+from heapq import heapify, heappop, heappush
+import logging
+from operator import itemgetter
 
-from .helper import get_logger
-from .model import Migration
+from .helper import Trace, get_logger
+from .model import Migration, SortedVMs
 
 logger = get_logger(__name__)
 
+ENGINES = ("reference", "numpy", "drain")
 
-def sort_max_imbalance(hosts):
+# Steps of the planners recorded in a trace
+TRACE_REMAINING = "Remaining imbalance: {!b}"
+TRACE_PAIR = "Trying migrating from host {} to host {}"
+TRACE_OVERSHOOT = (
+    "VM {} (memory={!b}) overshoots target host's imbalance of {!b} by more "
+    "than {!b}"
+)
+TRACE_PLAN = "Planning migration of VM {} to host {}"
+
+
+class HostQueue:
     """
-    Sorts the hosts by memory imbalance and returns the greatest absolute
-    imbalance
+    Priority queue of hosts ordered by imbalance, ascending (most over-loaded
+    host first) or descending (most under-loaded host first).
+
+    Hosts whose imbalance changed have to be pushed again. Outdated entries
+    stay in the heap and are skipped lazily.
+
+    Ties are broken like by sorting a list of the hosts by descending
+    imbalance after every change, which keeps hosts of equal imbalance in
+    their previous order: Initially, hosts are in their original order. A
+    host whose imbalance decreased comes before the hosts it ties with, one
+    whose imbalance increased after them. The ascending queue yields ties in
+    the reverse order.
     """
-    hosts.sort(key=attrgetter("memory_imbalance"), reverse=True)
-    return max_imbalance(hosts)
 
+    def __init__(self, hosts, descending=False):
+        self.sign = -1 if descending else 1
+        # Position of each host in the sorted list, and the lowest and
+        # highest position taken
+        self.position = {host: i for i, host in enumerate(hosts)}
+        self.lowest = 0
+        self.highest = len(hosts) - 1
+        self.entries = {host: self._entry(host) for host in hosts}
+        self.heap = list(self.entries.values())
+        heapify(self.heap)
+
+    def _entry(self, host):
+        return (
+            self.sign * host.imbalance,
+            -self.sign * self.position[host],
+            host,
+        )
 
-def max_imbalance(hosts):
+    def _is_current(self, entry):
+        return self.entries[entry[2]] is entry
+
+    def push(self, host):
+        imbalance = self.sign * self.entries[host][0]
+        if host.imbalance < imbalance:
+            self.lowest -= 1
+            self.position[host] = self.lowest
+        elif host.imbalance > imbalance:
+            self.highest += 1
+            self.position[host] = self.highest
+
+        entry = self._entry(host)
+        self.entries[host] = entry
+        heappush(self.heap, entry)
+
+        if len(self.heap) > 2 * len(self.entries):
+            self.heap = list(self.entries.values())
+            heapify(self.heap)
+
+    def first(self):
+        while not self._is_current(self.heap[0]):
+            heappop(self.heap)
+        return self.heap[0][2]
+
+    def __iter__(self):
+        """
+        Yields the hosts in queue order without modifying the queue. The
+        queue must not be pushed to while iterating.
+        """
+        heap = self.heap
+        candidates = [(heap[0], 0)] if heap else []
+        while candidates:
+            entry, i = heappop(candidates)
+            if self._is_current(entry):
+                yield entry[2]
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heappush(candidates, (heap[child], child))
+
+
+def max_imbalance(donors, receivers):
     """
-    Given a list sorted by memory imbalance, returns the greatest absolute
-    imbalance
+    Given the ascending and descending queues of hosts, returns the greatest
+    absolute imbalance
     """
     return max((
-        abs(hosts[0].memory_imbalance),
-        abs(hosts[-1].memory_imbalance),
+        abs(donors.first().imbalance),
+        abs(receivers.first().imbalance),
     ))
 
 
-def calculate_migrations(hosts, exclude=[], threshold=1024**3):
-    migrations = []
+def host_pairs(donors, receivers, exclude, signed=True):
+    """
+    Yields pairs of source and target hosts, from the most over-loaded to the
+    most under-loaded host. Unless `signed` is false, pairs that can't improve
+    the balance because of the sign of their imbalance are skipped.
+
+    Otherwise, the sign of the combined imbalance tells nothing, but a
+    migration still only improves the balance if the source host is
+    over-loaded and the target host under-loaded in memory or CPU. Other pairs
+    are skipped unless the source host is excluded.
+    """
+    for source_host in donors:
+        if signed and source_host.imbalance > 0:
+            break
 
-    if not hosts:
-        return migrations
+        prune = not signed and source_host not in exclude
+        memory = source_host.memory_imbalance < 0
+        cpu = source_host.cpu_imbalance < 0
+        if prune and not (memory or cpu):
+            continue
+
+        for target_host in receivers:
+            if signed and target_host.imbalance < 0:
+                break
+
+            if target_host in exclude or target_host is source_host:
+                continue
+
+            if prune and not (
+                memory and target_host.memory_imbalance > 0
+                or cpu and target_host.cpu_imbalance > 0
+            ):
+                continue
+
+            yield source_host, target_host
 
-    # Avoid changing the collection outside this function
-    hosts = list(hosts)
 
+def set_memory_imbalance(hosts, exclude):
+    """
+    Calculates the initial memory imbalance of all hosts and returns the
+    target memory ratio
+    """
     target_ratio = sum(host.used_memory for host in hosts)
     target_ratio /= sum(
         host.total_memory for host in hosts
         if host not in exclude
     )
 
-    # Calculate the initial memory imbalance
     for host in hosts:
         if host in exclude:
             # If we want to exclude the host, fake it's target memory
@@ -53,87 +164,280 @@ def calculate_migrations(hosts, exclude=[], threshold=1024**3):
 
         host.memory_imbalance -= host.used_memory
 
-    del host
-
-    logger.info(
-        "Target memory ratio is {:.0%}, starting memory imbalance is {!b}",
-        target_ratio,
-        sort_max_imbalance(hosts),
-    )
-
     if target_ratio > 0.9:
         logger.warning(
             "Target memory ratio {:.0%} is over 90%",
             target_ratio,
         )
 
-    while sort_max_imbalance(hosts) > threshold:
-        logger.debug(
-            "Remaining memory imbalance: {!b}",
-            max_imbalance(hosts),
+    return target_ratio
+
+
+def set_cpu_imbalance(hosts, exclude, weight):
+    """
+    Calculates the CPU imbalance of all hosts and their imbalance combining
+    memory and CPU. CPU cores are converted to bytes by their share of the
+    cluster's resources, multiplied by the weight. Returns the number of
+    bytes a CPU core is worth.
+    """
+    for host in hosts:
+        host.cpu_imbalance = 0
+        host.imbalance = host.memory_imbalance
+
+    total_cpu = sum(host.total_cpu for host in hosts if host not in exclude)
+    if not weight or not total_cpu:
+        return 0
+
+    cpu_factor = weight * sum(
+        host.total_memory for host in hosts
+        if host not in exclude
+    ) / total_cpu
+    target_ratio = sum(host.used_cpu for host in hosts) / total_cpu
+
+    for host in hosts:
+        if host not in exclude:
+            host.cpu_imbalance = target_ratio * host.total_cpu
+        host.cpu_imbalance -= host.used_cpu
+        host.cpu_imbalance *= cpu_factor
+        host.imbalance += host.cpu_imbalance
+
+    logger.info(
+        "Target CPU ratio is {:.0%}, a CPU core weighs {!b}",
+        target_ratio,
+        cpu_factor,
+    )
+
+    return cpu_factor
+
+
+def shift_imbalance(vm, source_host, target_host, cpu_factor=0):
+    """
+    Updates the imbalances of both hosts for migrating the VM between them
+    """
+    memory = vm.used_memory
+    cpu = cpu_factor * vm.cpu
+    source_host.memory_imbalance += memory
+    target_host.memory_imbalance -= memory
+    source_host.cpu_imbalance += cpu
+    target_host.cpu_imbalance -= cpu
+    source_host.imbalance += memory + cpu
+    target_host.imbalance -= memory + cpu
+
+
+def shift_usage(vm, source_host, target_host):
+    """
+    Updates the used memory and CPU of both hosts for migrating the VM
+    between them
+    """
+    source_host.used_memory -= vm.used_memory
+    target_host.used_memory += vm.used_memory
+    source_host.used_cpu -= vm.cpu
+    target_host.used_cpu += vm.cpu
+
+
+def measure_imbalance(hosts, exclude=[], cpu_weight=0):
+    """
+    Returns the largest memory or CPU imbalance of the hosts, as it would be
+    reduced by planning migrations
+    """
+    if not hosts:
+        return 0
+
+    set_memory_imbalance(hosts, exclude)
+    set_cpu_imbalance(hosts, exclude, cpu_weight)
+    return max(
+        max(abs(host.memory_imbalance), abs(host.cpu_imbalance))
+        for host in hosts
+    )
+
+
+def warn_remaining_vms(exclude, planned):
+    """
+    Warns about VMs on excluded hosts that are not planned for migration
+    """
+    for host in exclude:
+        rem = frozenset(host.vms).difference(planned)
+        if rem:
+            logger.warning(
+                "Terminating without fully emptying {0.name}! "
+                "The following VMs remain: {1!r}",
+                host,
+                rem
+            )
+
+
+def cost_key(residual, threshold, cost):
+    """
+    Returns a sort key for VMs, preferring the cheapest of the VMs that bring
+    the source host within the threshold, then the VMs with the least cost
+    per byte of memory they move
+    """
+    def key(vm):
+        if residual(vm) <= threshold:
+            return (0, cost(vm))
+        return (1, cost(vm) / vm.used_memory)
+
+    return key
+
+
+def imbalance_change(source_host, target_host, cpu_factor):
+    """
+    Returns a function giving the change of the summed absolute memory and CPU
+    imbalance of both hosts if a VM is migrated between them
+    """
+    def change(vm):
+        cpu = cpu_factor * vm.cpu
+        return (
+            abs(source_host.memory_imbalance + vm.used_memory)
+            - abs(source_host.memory_imbalance)
+            + abs(source_host.cpu_imbalance + cpu)
+            - abs(source_host.cpu_imbalance)
+            + abs(target_host.memory_imbalance - vm.used_memory)
+            - abs(target_host.memory_imbalance)
+            + abs(target_host.cpu_imbalance - cpu)
+            - abs(target_host.cpu_imbalance)
         )
 
-        # Migrate from the most over-loaded to the most under-loaded host
-        for source_host, target_host in product(reversed(hosts), hosts):
-            if source_host.memory_imbalance > 0:
-                continue
+    return change
 
-            if target_host.memory_imbalance < 0:
-                continue
 
-            if target_host in exclude:
-                continue
+def candidate_vms(source_host, target_host, threshold, cost=None,
+                  cpu_factor=0, exclude=()):
+    """
+    Returns the VMs of the source host worth migrating to the target host, in
+    order of preference.
+
+    Balancing memory only, prefer migrating VMs that bring the source host
+    closest to the target ratio without overshooting it by more than the
+    threshold. In case of a tie, prefer VMs with little memory, as they
+    migrate faster.
+
+    Balancing CPU as well, prefer the VMs reducing the imbalance of both
+    hosts in all dimensions the most, and skip VMs not reducing it at all.
+    """
+    if cpu_factor:
+        # Score each VM once, then sort by score. Sorting is stable, so ties
+        # keep the order of the VMs by used memory.
+        change = imbalance_change(source_host, target_host, cpu_factor)
+        scored = [(change(vm), vm) for vm in source_host.sorted_vms]
+        if source_host not in exclude:
+            scored = [(score, vm) for score, vm in scored if score < 0]
+        if cost is None:
+            scored.sort(key=itemgetter(0))
+        else:
+            # Prefer the largest improvement per transferred byte
+            scored.sort(key=lambda item: (item[0] / cost(item[1]), item[0]))
+        return [vm for score, vm in scored]
+
+    def residual(vm):
+        return abs(vm.used_memory + source_host.memory_imbalance)
+
+    vms = source_host.sorted_vms.closest(
+        -source_host.memory_imbalance,
+        -source_host.memory_imbalance + threshold,
+    )
+    if cost is not None:
+        vms = sorted(vms, key=cost_key(residual, threshold, cost))
+
+    return vms
+
+
+def calculate_migrations(hosts, exclude=[], threshold=1024**3, stats=None,
+                         cost=None, cpu_weight=0, trace=None):
+    """
+    Plans migrations until the memory imbalance of all hosts is below the
+    threshold. If given, the `stats` Counter is updated with the number of
+    planning iterations, host pairs tried, VMs evaluated and VMs rejected by
+    reason.
+
+    By default, as few migrations as possible are planned. If a `cost`
+    function is given, VMs are chosen to transfer as few bytes as possible,
+    as estimated by that function.
+
+    With a `cpu_weight`, the CPU usage of hosts is balanced as well. A weight
+    of 1 makes the cluster's share of CPU cores count as much as the share of
+    memory.
+
+    The steps taken are recorded in the `trace`, if given. Otherwise, they
+    are traced and logged at the end if debug logging is enabled.
+    """
+    if stats is None:
+        stats = Counter()
+
+    # Logging every step is expensive even if debug logging is disabled, so
+    # steps are only added to a trace if one is wanted
+    log_trace = trace is None and logger.isEnabledFor(logging.DEBUG)
+    if log_trace:
+        trace = Trace()
 
-            logger.debug(
-                "Trying migrating from host {} to host {}",
-                source_host.name,
-                target_host.name,
+    # Maps each VM planned for migration to its target host name. Dicts keep
+    # insertion order, so this doubles as the ordered list of migrations.
+    planned = {}
+
+    if not hosts:
+        return []
+
+    # Avoid changing the collection outside this function
+    hosts = list(hosts)
+    exclude = set(exclude)
+
+    target_ratio = set_memory_imbalance(hosts, exclude)
+    cpu_factor = set_cpu_imbalance(hosts, exclude, cpu_weight)
+
+    for host in hosts:
+        # VMs without used memory won't change anything, so skip them early
+        host.sorted_vms = SortedVMs(vm for vm in host.vms if vm.used_memory)
+
+    del host
+
+    donors = HostQueue(hosts)
+    receivers = HostQueue(hosts, descending=True)
+
+    def remaining_imbalance():
+        if cpu_factor:
+            return max(
+                max(abs(host.memory_imbalance), abs(host.cpu_imbalance))
+                for host in hosts
             )
+        return max_imbalance(donors, receivers)
 
-            # In case of a tie (see below criterion), prefer VMs with little
-            # memory, as they migrate faster
-            vms = sorted(source_host.vms, key=attrgetter("used_memory"))
+    logger.info(
+        "Target memory ratio is {:.0%}, starting imbalance is {!b}",
+        target_ratio,
+        remaining_imbalance(),
+    )
 
-            # Prefer migrating VMs that bring the source host closest to the
-            # target memory ratio
-            vms.sort(
-                key=lambda x: abs(x.used_memory + source_host.memory_imbalance)
+    while remaining_imbalance() > threshold:
+        stats["iterations"] += 1
+        if trace is not None:
+            trace.add(TRACE_REMAINING, remaining_imbalance())
+
+        # Migrate from the most over-loaded to the most under-loaded host.
+        # With CPU, a host may be over-loaded in one dimension only, so any
+        # pair of hosts may improve the balance.
+        pairs = host_pairs(donors, receivers, exclude, signed=not cpu_factor)
+        for source_host, target_host in pairs:
+            stats["host_pairs"] += 1
+            if trace is not None:
+                trace.add(TRACE_PAIR, source_host.name, target_host.name)
+
+            vms = candidate_vms(
+                source_host, target_host, threshold, cost, cpu_factor, exclude,
             )
 
-            for vm in vms:
-                if Migration(vm, source_host.name) in migrations:
-                    logger.debug(
-                        "VM {} is already planned for migration to {}, but "
-                        "is now reconsidered!",
-                        vm.id,
-                        source_host.name,
-                    )
-                elif vm in (migration.vm for migration in migrations):
-                    logger.debug(
-                        "VM {} is already planned for migration, ignoring it",
-                        vm.id,
-                    )
-                    continue
-
-                if vm.used_memory == 0:
-                    continue
-
-                if vm.used_memory > -source_host.memory_imbalance + threshold:
-                    logger.debug(
-                        "VM {0.id} (memory={0.used_memory!b}) overshoots "
-                        "source host's imbalance of {1.memory_imbalance!b} by "
-                        "more than {2!b}",
-                        vm, source_host, threshold,
-                    )
-                    continue
+            if cpu_factor:
+                stats["rejected_no_improvement"] += (
+                    len(source_host.sorted_vms) - len(vms)
+                )
 
+            for vm in vms:
+                stats["vms_evaluated"] += 1
                 if vm.used_memory > target_host.memory_imbalance + threshold:
-                    logger.debug(
-                        "VM {0.id} (memory={0.used_memory!b}) overshoots "
-                        "target host's imbalance of {1.memory_imbalance!b} "
-                        "by more than {2!b}",
-                        vm, target_host, threshold,
-                    )
+                    if trace is not None:
+                        trace.add(
+                            TRACE_OVERSHOOT, vm.id, vm.used_memory,
+                            target_host.memory_imbalance, threshold,
+                        )
                     if source_host in exclude:
                         logger.info(
                             "Migrating VM {0.id} from host {1.name} to host "
@@ -143,6 +447,7 @@ def calculate_migrations(hosts, exclude=[], threshold=1024**3):
                             vm.used_memory - target_host.memory_imbalance,
                         )
                     else:
+                        stats["rejected_target_overshoot"] += 1
                         continue
 
                 # This migration seems useful, remember it and update the
@@ -155,14 +460,11 @@ def calculate_migrations(hosts, exclude=[], threshold=1024**3):
                     source_host,
                     target_host,
                 )
-                try:
-                    migrations.remove(Migration(vm, source_host.name))
-                except ValueError:
-                    # no such migration planned, good!
-                    pass
-                migrations.append(Migration(vm, target_host.name))
-                source_host.memory_imbalance += vm.used_memory
-                target_host.memory_imbalance -= vm.used_memory
+                if trace is not None:
+                    trace.add(TRACE_PLAN, vm.id, target_host.name)
+                planned[vm] = target_host.name
+                source_host.sorted_vms.remove(vm)
+                shift_imbalance(vm, source_host, target_host, cpu_factor)
 
                 # Break the VM loop to re-order hosts first
                 break
@@ -180,18 +482,34 @@ def calculate_migrations(hosts, exclude=[], threshold=1024**3):
             # host. So apparently, we're done.
             break
 
+        # Only the two hosts involved changed their position in the queues
+        pairs.close()
+        for host in (source_host, target_host):
+            donors.push(host)
+            receivers.push(host)
+
+    if log_trace:
+        logger.debug("Planning steps:\n{}", trace)
     logger.info(
-        "Terminating with a remaining memory imbalance of {!b}",
-        max_imbalance(hosts),
+        "Terminating with a remaining imbalance of {!b}",
+        remaining_imbalance(),
     )
-    for host in exclude:
-        rem = frozenset(host.vms) - {migration.vm for migration in migrations}
-        if rem:
-            logger.warning(
-                "Terminating without fully emptying {0.name}! "
-                "The following VMs remain: {1!r}",
-                host,
-                rem
-            )
+    warn_remaining_vms(exclude, planned)
 
-    return migrations
+    return [Migration(vm, target) for vm, target in planned.items()]
+
+
+def get_engine(name):
+    """
+    Returns the function calculating the migrations for the named engine
+    """
+    if name == "reference":
+        return calculate_migrations
+    if name == "numpy":
+        # NumPy is an optional dependency, so only import it when needed
+        from .vectorized import calculate_migrations as engine
+        return engine
+    if name == "drain":
+        from .drain import calculate_migrations as engine
+        return engine
+    raise ValueError("Unknown planning engine {!r}".format(name))
@@ -0,0 +1,331 @@
+"""
+Benchmark of the planning engines on synthetic clusters.
+
+Run ``python -m pve_balance.benchmark --help`` for the available options.
+Clusters are generated from a seed, so results are reproducible and no
+Proxmox cluster is needed.
+"""
+from collections import Counter
+from itertools import product
+from random import Random
+from time import perf_counter
+import logging
+import os
+import tracemalloc
+
+from .algorithm import ENGINES, get_engine
+from .helper import ByteFormatter
+from .localsearch import improve_migrations
+from .model import Host, VM, VMTable
+from .snapshot import read_snapshot
+
+
+DISTRIBUTIONS = ("uniform", "heavy-tailed", "huge")
+
+# How VMs are stored, as tuples or in a columnar VMTable
+MODELS = ("tuple", "columnar")
+
+GiB = 1024 ** 3
+
+
+def vm_sizes(rng, distribution, count):
+    """
+    Yields `count` VM memory sizes in bytes drawn from the named distribution
+    """
+    for _ in range(count):
+        if distribution == "uniform":
+            size = rng.uniform(0.5, 16)
+        elif distribution == "heavy-tailed":
+            size = min(0.5 * rng.paretovariate(1.5), 512)
+        elif distribution == "huge":
+            # Mostly small VMs and a few really big ones
+            if rng.random() < 0.01:
+                size = rng.uniform(128, 512)
+            else:
+                size = rng.uniform(0.5, 4)
+        else:
+            raise ValueError(
+                "Unknown size distribution {!r}".format(distribution)
+            )
+        yield int(size * GiB)
+
+
+def generate_cluster(num_hosts, num_vms, distribution="uniform", skew=0.0,
+                     num_excluded=0, seed=0, utilization=0.6, model="tuple"):
+    """
+    Generates a synthetic cluster and returns its hosts and the hosts to
+    exclude. The VMs are stored as given by `model`, one of `MODELS`.
+
+    With a `skew` of 0, VMs are spread evenly across the hosts. Greater
+    values put exponentially more VMs on the first hosts. Host memory is
+    chosen so that the cluster ends up at the given `utilization`.
+    """
+    if model not in MODELS:
+        raise ValueError("Unknown VM model {!r}".format(model))
+
+    rng = Random(seed)
+    names = ["node{:04d}".format(i) for i in range(num_hosts)]
+    weights = [2 ** (-skew * i * 10 / num_hosts) for i in range(num_hosts)]
+    make_vm = VMTable().append if model == "columnar" else VM
+
+    vms = [[] for _ in range(num_hosts)]
+    for i, size in enumerate(vm_sizes(rng, distribution, num_vms)):
+        host = rng.choices(range(num_hosts), weights)[0]
+        vms[host].append(make_vm(
+            id=100 + i,
+            used_memory=size,
+            total_memory=size + size // 4,
+            host=names[host],
+        ))
+
+    # Every host uses some memory for itself
+    overhead = 2 * GiB
+    used = sum(vm.used_memory for host_vms in vms for vm in host_vms)
+    total = (used + overhead * num_hosts) / utilization / num_hosts
+    hosts = [
+        Host(
+            name=name,
+            used_memory=overhead + sum(vm.used_memory for vm in host_vms),
+            # Vary the host sizes a little and round them to whole GiB
+            total_memory=GiB * round(rng.choice((0.5, 1, 1, 2)) * total / GiB),
+            vms=host_vms,
+        )
+        for name, host_vms in zip(names, vms)
+    ]
+    for host in hosts:
+        host.total_memory = max(host.total_memory, host.used_memory)
+
+    return hosts, rng.sample(hosts, num_excluded)
+
+
+def measure(engine, make_cluster, threshold=GiB, repeat=3, time_budget=0):
+    """
+    Plans migrations for the hosts and excluded hosts returned by
+    `make_cluster` and returns a dict of the measurements. Given a
+    `time_budget`, they are improved by the local search. The wall time is
+    the best of `repeat` runs, the peak memory is measured in a separate run.
+    The memory per VM is the memory taken by the hosts and VMs divided by
+    the number of VMs.
+    """
+    calculate_migrations = get_engine(engine)
+
+    def plan(hosts, exclude, stats):
+        start = perf_counter()
+        migrations = calculate_migrations(hosts, exclude, threshold, stats)
+        if time_budget:
+            migrations = improve_migrations(
+                hosts, exclude, migrations, threshold, time_budget,
+                stats=stats,
+            )
+        return perf_counter() - start, migrations
+
+    wall_time = min(
+        plan(*make_cluster(), Counter())[0] for _ in range(repeat)
+    )
+
+    stats = Counter()
+    tracemalloc.start()
+    try:
+        hosts, exclude = make_cluster()
+        cluster_memory, _ = tracemalloc.get_traced_memory()
+        _, migrations = plan(hosts, exclude, stats)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    num_vms = sum(len(host.vms) for host in hosts)
+    return {
+        "wall_time": wall_time,
+        "peak_memory": peak_memory,
+        "memory_per_vm": cluster_memory / num_vms if num_vms else 0,
+        "iterations": stats["iterations"],
+        "host_pairs": stats["host_pairs"],
+        "migrations": len(migrations),
+        "bytes": sum(migration.vm.used_memory for migration in migrations),
+        "remaining_imbalance": max(
+            (abs(host.memory_imbalance) for host in hosts), default=0,
+        ),
+    }
+
+
+def run(engine, num_hosts, num_vms, distribution="uniform", skew=0.0,
+        num_excluded=0, seed=0, threshold=GiB, repeat=3, model="tuple",
+        time_budget=0):
+    """
+    Plans migrations for a synthetic cluster and returns a dict of the
+    measurements
+    """
+    def make_cluster():
+        return generate_cluster(
+            num_hosts, num_vms, distribution, skew, num_excluded, seed,
+            model=model,
+        )
+
+    result = {
+        "engine": engine,
+        "model": model,
+        "hosts": num_hosts,
+        "vms": num_vms,
+        "distribution": distribution,
+        "skew": skew,
+        "excluded": num_excluded,
+        "seed": seed,
+        "time_budget": time_budget,
+    }
+    result.update(measure(
+        engine, make_cluster, threshold, repeat, time_budget,
+    ))
+    return result
+
+
+def run_snapshot(engine, path, threshold=GiB, repeat=3, time_budget=0):
+    """
+    Plans migrations for a cluster recorded with ``--record`` and returns a
+    dict of the measurements
+    """
+    hosts, exclude = read_snapshot(path)
+    result = {
+        "engine": engine,
+        "model": "columnar",
+        "hosts": len(hosts),
+        "vms": sum(len(host.vms) for host in hosts),
+        "distribution": os.path.basename(path),
+        "skew": "-",
+        "excluded": len(exclude),
+        "seed": None,
+        "time_budget": time_budget,
+    }
+    result.update(measure(
+        engine, lambda: read_snapshot(path), threshold, repeat, time_budget,
+    ))
+    return result
+
+
+def format_result(result):
+    formatter = ByteFormatter()
+    result = dict(result)
+    for key in ("peak_memory", "bytes", "remaining_imbalance"):
+        result[key] = formatter.format("{!b}", result[key])
+
+    return (
+        "{engine:>9} {model:>8} {hosts:>5} {vms:>7} {distribution:>12} "
+        "{skew:>4} {excluded:>3} {time_budget:>6g} {wall_time:>8.3f}s "
+        "{peak_memory:>10} "
+        "{memory_per_vm:>6.0f} "
+        "{iterations:>6} {migrations:>6} {bytes:>10} "
+        "{remaining_imbalance:>10}"
+    ).format(**result)
+
+
+def main():
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the planning engines on synthetic clusters."
+    )
+    parser.add_argument(
+        "--hosts", type=int, nargs="+", default=[8, 32, 64],
+        help="Numbers of hosts to benchmark",
+    )
+    parser.add_argument(
+        "--vms", type=int, nargs="+", default=[200, 1000, 5000],
+        help="Numbers of VMs to benchmark",
+    )
+    parser.add_argument(
+        "--engine", choices=ENGINES, nargs="+", default=["reference"],
+    )
+    parser.add_argument(
+        "--model", choices=MODELS, nargs="+", default=["tuple"],
+        help="How to store the VMs of synthetic clusters",
+    )
+    parser.add_argument(
+        "--distribution", choices=DISTRIBUTIONS, default="uniform",
+        help="Distribution of the VM memory sizes",
+    )
+    parser.add_argument(
+        "--skew", type=float, default=0.5,
+        help="How unevenly VMs are spread across hosts, 0 being even",
+    )
+    parser.add_argument(
+        "--exclude", type=int, default=0, metavar="N",
+        help="Number of randomly chosen hosts to exclude",
+    )
+    parser.add_argument(
+        "--snapshot", nargs="+", default=[], metavar="FILE",
+        help="""
+            Benchmark clusters recorded with pve_balance --record instead of
+            synthetic ones
+        """,
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--threshold", type=float, default=1,
+        help="Threshold of memory imbalance in GiB",
+    )
+    parser.add_argument(
+        "--plan-time-budget", type=float, nargs="+", default=[0],
+        metavar="SECONDS",
+        help="""
+            Time budgets of the local search improving the plans, 0 being
+            the engine alone
+        """,
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="Number of timed runs per cluster, the best one is reported",
+    )
+    parser.add_argument(
+        "--json", action="store_true",
+        help="Print one JSON object per benchmark instead of a table",
+    )
+    args = parser.parse_args()
+
+    # The planners log every migration, which would distort the timings
+    logging.disable(logging.INFO)
+
+    if not args.json:
+        print(
+            "   engine    model hosts     vms distribution skew exc budget "
+            "     time   peak mem   B/VM  iters  migr.      bytes  remaining"
+        )
+    if args.snapshot:
+        results = (
+            run_snapshot(
+                engine, path,
+                threshold=args.threshold * GiB,
+                repeat=args.repeat,
+                time_budget=time_budget,
+            )
+            for engine, time_budget, path in product(
+                args.engine, args.plan_time_budget, args.snapshot
+            )
+        )
+    else:
+        results = (
+            run(
+                engine, num_hosts, num_vms,
+                distribution=args.distribution,
+                skew=args.skew,
+                num_excluded=args.exclude,
+                seed=args.seed,
+                threshold=args.threshold * GiB,
+                repeat=args.repeat,
+                model=model,
+                time_budget=time_budget,
+            )
+            for engine, model, time_budget, num_hosts, num_vms in product(
+                args.engine, args.model, args.plan_time_budget, args.hosts,
+                args.vms,
+            )
+        )
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(format_result(result))
+
+
+if __name__ == "__main__":
+    main()
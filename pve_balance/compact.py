@@ -0,0 +1,130 @@
+"""
+Compacting a plan of migrations after planning.
+
+A plan may contain migrations whose net effect on the hosts could be had
+with fewer of them: a VM migrating from host A to host B while a VM of about
+the same size migrates from B to C, or from B back to A. The first VM can
+migrate to C directly instead, or both can stay where they are. As long as
+the VMs are about the same size, the hosts end up about as balanced, with a
+migration or two less to execute.
+"""
+from collections import Counter, defaultdict
+
+from .algorithm import set_cpu_imbalance, set_memory_imbalance
+from .cost import migration_bytes
+from .helper import get_logger
+from .model import Migration
+
+logger = get_logger(__name__)
+
+
+def compact_migrations(hosts, exclude, migrations, tolerance=256 * 1024**2,
+                       cpu_weight=0, stats=None):
+    """
+    Returns the migrations with chains collapsed and migrations cancelling
+    each other dropped, where the VMs involved differ by up to `tolerance`
+    bytes of memory and, with a `cpu_weight`, of CPU. The usage of no host
+    drifts by more than `tolerance` from the plan. VMs planned more than
+    once migrate to their last target only. If given, the `stats` Counter is
+    updated with the number of chains, cancellations and duplicates.
+
+    As no migration targets an excluded host, VMs that no longer migrate
+    stay on hosts that aren't excluded.
+    """
+    if stats is None:
+        stats = Counter()
+
+    cpu_factor = 0
+    if cpu_weight and hosts:
+        set_memory_imbalance(hosts, exclude)
+        cpu_factor = set_cpu_imbalance(hosts, exclude, cpu_weight)
+
+    # Last target host of each VM, moved to the end of the plan on every new
+    # target
+    planned = {}
+    for migration in migrations:
+        planned.pop(migration.vm, None)
+        planned[migration.vm] = migration.target_host
+    for vm, target in list(planned.items()):
+        if target == vm.host:
+            del planned[vm]
+    stats["compacted_duplicates"] += len(migrations) - len(planned)
+
+    # Change of the hosts' memory and CPU usage compared to the plan
+    memory_drift = Counter()
+    cpu_drift = Counter()
+
+    def drifts(changes):
+        """
+        Returns whether changing the usage of the hosts by the VMs' memory
+        and CPU keeps them within the tolerance
+        """
+        return all(
+            abs(memory_drift[host] + memory) <= tolerance
+            and abs(cpu_drift[host] + cpu) * cpu_factor <= tolerance
+            for host, memory, cpu in changes
+        )
+
+    changed = True
+    while changed:
+        changed = False
+        leaving = defaultdict(list)
+        for vm in planned:
+            leaving[vm.host].append(vm)
+
+        for vm in list(planned):
+            target = planned.get(vm)
+            if target is None:
+                continue
+
+            for other in sorted(
+                leaving[target],
+                key=lambda other: abs(other.used_memory - vm.used_memory),
+            ):
+                if other not in planned:
+                    continue
+                memory = other.used_memory - vm.used_memory
+                cpu = other.cpu - vm.cpu
+                other_target = planned[other]
+                if other_target == vm.host:
+                    changes = (
+                        (vm.host, -memory, -cpu), (target, memory, cpu),
+                    )
+                else:
+                    changes = (
+                        (target, memory, cpu), (other_target, -memory, -cpu),
+                    )
+                if not drifts(changes):
+                    continue
+
+                for host, memory, cpu in changes:
+                    memory_drift[host] += memory
+                    cpu_drift[host] += cpu
+                del planned[other]
+                if other_target == vm.host:
+                    stats["compacted_cancellations"] += 1
+                    logger.info(
+                        "Cancelling migrations of VM {} from host {} to "
+                        "host {} and VM {} back",
+                        vm.id, vm.host, target, other.id,
+                    )
+                    del planned[vm]
+                else:
+                    stats["compacted_chains"] += 1
+                    logger.info(
+                        "Migrating VM {} from host {} to host {} directly, "
+                        "instead of VM {} from host {}",
+                        vm.id, vm.host, other_target, other.id, target,
+                    )
+                    planned[vm] = other_target
+                changed = True
+                break
+
+    compacted = [Migration(vm, target) for vm, target in planned.items()]
+    logger.info(
+        "Compaction saved {} migrations and {!b}",
+        len(migrations) - len(compacted),
+        sum(migration_bytes(migration.vm) for migration in migrations)
+        - sum(migration_bytes(migration.vm) for migration in compacted),
+    )
+    return compacted
@@ -0,0 +1,17 @@
+"""
+Estimates of the amount of data transferred by live migrations.
+"""
+
+# Share of a VM's used memory that is dirtied during a live migration, and
+# thus has to be sent again, per CPU core the VM keeps busy
+DIRTY_RATIO_PER_CORE = 0.1
+MAX_DIRTY_RATIO = 1.0
+
+
+def migration_bytes(vm):
+    """
+    Estimates the bytes transferred by migrating the VM: its used memory,
+    the memory dirtied meanwhile and its disks on local storage
+    """
+    dirty_ratio = min(vm.cpu * DIRTY_RATIO_PER_CORE, MAX_DIRTY_RATIO)
+    return vm.used_memory * (1 + dirty_ratio) + vm.local_disk
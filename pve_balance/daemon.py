@@ -0,0 +1,59 @@
+"""
+Balancing the cluster repeatedly from a long-running process.
+"""
+from signal import SIGINT, SIGTERM, signal
+from threading import Event
+
+from proxmoxer.core import ResourceException
+from requests import RequestException
+
+from . import balance, connect
+from .executor import DEFAULT_BANDWIDTH, BandwidthEstimate
+from .helper import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def run_daemon(pve_config, interval=300, trigger=2 * 1024 ** 3, timeout=None,
+               bandwidth=DEFAULT_BANDWIDTH, **options):
+    """
+    Balances the cluster every `interval` seconds until SIGTERM or SIGINT is
+    received, keeping the API session, the bandwidth estimate and the disk
+    sizes of VMs in between. Migrations are only planned once the imbalance
+    exceeds the trigger and always waited for, so the next run sees their
+    effect. Further options are passed to :func:`pve_balance.balance`.
+    """
+    stop = Event()
+
+    def terminate(signum, frame):
+        logger.info("Received signal {}, stopping", signum)
+        stop.set()
+
+    for signum in (SIGTERM, SIGINT):
+        signal(signum, terminate)
+
+    proxmox = connect(pve_config, timeout)
+    estimate = BandwidthEstimate(bandwidth)
+    disk_sizes = {}
+    while not stop.is_set():
+        try:
+            balance(
+                pve_config,
+                wait=True,
+                proxmox=proxmox,
+                trigger=trigger,
+                estimate=estimate,
+                disk_sizes=disk_sizes,
+                stop=stop,
+                **options
+            )
+        except (ResourceException, RequestException) as e:
+            logger.error("Balancing failed, retrying later: {}", e)
+        except Exception:
+            # Keep running on unexpected errors, e.g. in API responses
+            logger.exception("Balancing failed unexpectedly, retrying later")
+
+        stop.wait(interval)
+
+    logger.info("Terminating daemon")
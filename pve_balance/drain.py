@@ -0,0 +1,129 @@
+"""
+Planning engine emptying the excluded hosts, e.g. for maintenance.
+
+Unlike the balancing engines, it doesn't reduce the imbalance of the other
+hosts. It assigns all VMs of the excluded hosts to the other hosts in a
+single pass, the largest VM first, each to the host whose headroom it fits
+best. A host's headroom is the memory it may take until it reaches the
+cluster's target memory ratio, plus the threshold, or its free memory if
+that is less.
+"""
+from bisect import bisect_left, insort
+from collections import Counter
+import logging
+
+from .algorithm import (
+    TRACE_PLAN,
+    set_cpu_imbalance,
+    set_memory_imbalance,
+    shift_imbalance,
+    warn_remaining_vms,
+)
+from .helper import Trace, get_logger
+from .model import Migration
+
+logger = get_logger(__name__)
+
+TRACE_HEADROOM = "VM {} (memory={!b}) fits into the headroom of host {}"
+TRACE_FREE = "VM {} (memory={!b}) fits no headroom, using host {}"
+
+
+def calculate_migrations(hosts, exclude=[], threshold=1024**3, stats=None,
+                         cost=None, cpu_weight=0, trace=None):
+    """
+    Plans migrations of all VMs of the excluded hosts to the other hosts.
+
+    VMs exceeding the headroom of every host go to the host with the most
+    free memory. VMs fitting into no host's free memory stay where they are
+    and are warned about. The `cost` and `cpu_weight` of the balancing
+    engines don't change the plan, as all VMs have to be migrated anyway.
+    """
+    if stats is None:
+        stats = Counter()
+
+    log_trace = trace is None and logger.isEnabledFor(logging.DEBUG)
+    if log_trace:
+        trace = Trace()
+
+    if not hosts:
+        return []
+
+    hosts = list(hosts)
+    exclude = set(exclude)
+
+    set_memory_imbalance(hosts, exclude)
+    set_cpu_imbalance(hosts, exclude, 0)
+
+    # Largest VMs first along with their host, VMs of equal memory in their
+    # original order
+    vms = sorted(
+        ((vm, host) for host in hosts if host in exclude for vm in host.vms),
+        key=lambda item: item[0].used_memory,
+        reverse=True,
+    )
+    receivers = [host for host in hosts if host not in exclude]
+
+    # Free memory of the receivers, and their headrooms in ascending order
+    # along with their index breaking ties. The headroom never exceeds the
+    # free memory, even if the target memory ratio is over 100%.
+    free = [host.total_memory - host.used_memory for host in receivers]
+    headrooms = sorted(
+        (min(host.memory_imbalance + threshold, free[i]), i)
+        for i, host in enumerate(receivers)
+    )
+
+    migrations = []
+    for vm, source_host in vms:
+        stats["vms_evaluated"] += 1
+        i = bisect_left(headrooms, (vm.used_memory, -1))
+        if i < len(headrooms):
+            headroom, index = headrooms.pop(i)
+            if trace is not None:
+                trace.add(
+                    TRACE_HEADROOM, vm.id, vm.used_memory,
+                    receivers[index].name,
+                )
+        else:
+            index = max(
+                range(len(receivers)), key=free.__getitem__, default=None,
+            )
+            if index is None or free[index] < vm.used_memory:
+                stats["vms_left"] += 1
+                continue
+
+            stats["rejected_target_overshoot"] += 1
+            if trace is not None:
+                trace.add(
+                    TRACE_FREE, vm.id, vm.used_memory, receivers[index].name,
+                )
+            i = next(
+                i for i, entry in enumerate(headrooms) if entry[1] == index
+            )
+            headroom, _ = headrooms.pop(i)
+
+        target_host = receivers[index]
+        insort(headrooms, (headroom - vm.used_memory, index))
+        free[index] -= vm.used_memory
+        shift_imbalance(vm, source_host, target_host)
+
+        logger.info(
+            "Planning migration of VM {0.id} (memory={0.used_memory!b}) "
+            "from host {1.name} to host {2.name}",
+            vm,
+            source_host,
+            target_host,
+        )
+        if trace is not None:
+            trace.add(TRACE_PLAN, vm.id, target_host.name)
+        migrations.append(Migration(vm, target_host.name))
+
+    if log_trace:
+        logger.debug("Planning steps:\n{}", trace)
+    logger.info(
+        "Planned draining {} hosts with {} migrations",
+        len(exclude),
+        len(migrations),
+    )
+    warn_remaining_vms(exclude, {migration.vm for migration in migrations})
+
+    return migrations
@@ -0,0 +1,282 @@
+from collections import Counter, namedtuple
+from time import monotonic, sleep
+
+from proxmoxer.core import ResourceException
+from requests import RequestException
+
+from .cost import migration_bytes
+from .helper import get_logger
+
+
+logger = get_logger(__name__)
+
+# Bandwidth assumed for migrations before any has been observed, in bytes
+# per second
+DEFAULT_BANDWIDTH = 500 * 1024 ** 2
+
+# Bounds of the interval between polls of the running tasks, in seconds
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 30
+
+# Maximum number of concurrent migrations leaving a host, entering a host,
+# touching a host in any direction and in the whole cluster. None means
+# unlimited.
+MigrationLimits = namedtuple(
+    "MigrationLimits",
+    ("outgoing", "incoming", "per_host", "total"),
+    defaults=(1, 1, 1, None),
+)
+
+
+def exceeds(count, limit):
+    return limit is not None and count >= limit
+
+
+class MigrationSlots:
+    """
+    Counts the running migrations per host to check them against the limits
+    """
+
+    def __init__(self, limits=MigrationLimits()):
+        self.limits = limits
+        self.outgoing = Counter()
+        self.incoming = Counter()
+        self.total = 0
+
+    def blocking_reason(self, migration):
+        """
+        Returns why the migration can't be started alongside the running ones
+        without exceeding the limits, or None if it can be started
+        """
+        limits = self.limits
+        source, target = migration.vm.host, migration.target_host
+
+        if exceeds(self.total, limits.total):
+            return "the cluster is busy"
+        if exceeds(self.outgoing[source], limits.outgoing):
+            return "{} is busy sending VMs".format(source)
+        if exceeds(self.incoming[target], limits.incoming):
+            return "{} is busy receiving VMs".format(target)
+        for host in (source, target):
+            if exceeds(self.outgoing[host] + self.incoming[host],
+                       limits.per_host):
+                return "{} is busy".format(host)
+
+        return None
+
+    def acquire(self, migration):
+        self.outgoing[migration.vm.host] += 1
+        self.incoming[migration.target_host] += 1
+        self.total += 1
+
+    def release(self, migration):
+        self.outgoing[migration.vm.host] -= 1
+        self.incoming[migration.target_host] -= 1
+        self.total -= 1
+
+
+class BandwidthEstimate:
+    """
+    Estimates the duration of migrations from the bandwidth observed for
+    completed migrations
+    """
+
+    def __init__(self, bandwidth=DEFAULT_BANDWIDTH, weight=0.3):
+        self.bandwidth = bandwidth
+        # Weight of a new observation in the moving average
+        self.weight = weight
+
+    def duration(self, migration):
+        return migration_bytes(migration.vm) / self.bandwidth
+
+    def observe(self, migration, duration):
+        size = migration_bytes(migration.vm)
+        if duration <= 0 or not size:
+            return
+        bandwidth = size / duration
+        self.bandwidth += self.weight * (bandwidth - self.bandwidth)
+
+
+def task_node(upid):
+    """
+    Returns the node a task is running on, given its UPID
+    """
+    return upid.split(":")[1]
+
+
+def task_result(proxmox, upid):
+    """
+    Returns None while the task is running or its status can't be queried,
+    so it is queried again at the next poll. Otherwise, returns whether the
+    task succeeded, logging failed tasks.
+    """
+    try:
+        status = proxmox.nodes(task_node(upid)).tasks(upid).status.get()
+    except (ResourceException, RequestException) as e:
+        logger.warning("Could not get status of task {}: {}", upid, e)
+        return None
+
+    if status["status"] == "running":
+        return None
+
+    if status.get("exitstatus") != "OK":
+        logger.warning(
+            "Task {} failed: {}",
+            upid,
+            status.get("exitstatus"),
+        )
+        return False
+    return True
+
+
+def poll_interval(running, started, estimate):
+    """
+    Returns the time to wait until the next poll, which is half of the time
+    the first of the running migrations is expected to take yet
+    """
+    now = monotonic()
+    remaining = min(
+        started[upid] + estimate.duration(migration) - now
+        for upid, migration in running.items()
+    )
+    return min(max(remaining / 2, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+
+def wait_for_tasks(proxmox, running, started, estimate, metrics=None):
+    """
+    Waits until at least one of the running tasks finished and returns the
+    migrations of all tasks that succeeded and that failed meanwhile. The
+    time waited, the durations of the succeeded migrations and the failed
+    migrations are added to the `metrics`, if given. Only succeeded
+    migrations update the bandwidth estimate.
+    """
+    logger.info(
+        "Waiting for completion of {} tasks",
+        len(running),
+    )
+
+    start = monotonic()
+    while True:
+        results = {upid: task_result(proxmox, upid) for upid in running}
+        finished = [
+            upid for upid, result in results.items() if result is not None
+        ]
+        if finished:
+            break
+        sleep(poll_interval(running, started, estimate))
+
+    if metrics is not None:
+        metrics.phases["waiting"] += monotonic() - start
+
+    succeeded = []
+    failed = []
+    for upid in finished:
+        migration = running.pop(upid)
+        duration = monotonic() - started.pop(upid)
+        if not results[upid]:
+            logger.warning(
+                "Migration of VM {0.vm.id} to host {0.target_host} failed "
+                "after {1:.0f}s",
+                migration,
+                duration,
+            )
+            if metrics is not None:
+                metrics.failed_migration(migration)
+            failed.append(migration)
+            continue
+
+        logger.info(
+            "Migration of VM {0.vm.id} to host {0.target_host} finished "
+            "after {1:.0f}s",
+            migration,
+            duration,
+        )
+        estimate.observe(migration, duration)
+        if metrics is not None:
+            metrics.migration(migration, duration)
+        succeeded.append(migration)
+    return succeeded, failed
+
+
+def execute_migrations(proxmox, migrations, limits=MigrationLimits(),
+                       wait=False, estimate=None, stop=None, replan=None,
+                       metrics=None):
+    """
+    Starts the migrations in order, as far as the limits of concurrent
+    migrations allow. Waits for the completion of all of them if `wait` is
+    set.
+
+    Once the `stop` event is set, no further migrations are started, but
+    those running are waited for.
+
+    Whenever migrations finished while others are pending, `replan` is
+    called with the succeeded, running, pending and failed migrations, if
+    given. It returns the migrations to execute instead of the pending ones.
+
+    Waiting times and durations of migrations are added to the `metrics`, if
+    given.
+    """
+    if estimate is None:
+        estimate = BandwidthEstimate()
+
+    migrations = list(migrations)
+    slots = MigrationSlots(limits)
+    running = {}
+    started = {}
+    while migrations:
+        if stop is not None and stop.is_set():
+            logger.warning(
+                "Stopping, not starting {} remaining migrations",
+                len(migrations),
+            )
+            wait = True
+            break
+
+        postponed = []
+        for migration in migrations:
+            reason = slots.blocking_reason(migration)
+            if reason:
+                logger.debug(
+                    "Postponing migration of VM {0.vm.id}, because {1}",
+                    migration,
+                    reason,
+                )
+                postponed.append(migration)
+                continue
+
+            logger.info(
+                "Migrating VM {0.vm.id} ({0.vm.used_memory!b}) from host "
+                "{0.vm.host} to host {0.target_host}.",
+                migration,
+            )
+
+            vm = migration.vm
+            task = proxmox.nodes(vm.host).qemu(vm.id).migrate.post(**{
+                "target": migration.target_host,
+                "online": 1,
+                "with-local-disks": 1,
+            })
+            del vm
+
+            slots.acquire(migration)
+            running[task] = migration
+            started[task] = monotonic()
+
+        migrations = postponed
+        if migrations:
+            # All remaining migrations are currently blocked by running
+            # migrations
+            succeeded, failed = wait_for_tasks(
+                proxmox, running, started, estimate, metrics,
+            )
+            for migration in succeeded + failed:
+                slots.release(migration)
+
+            if replan is not None:
+                migrations = replan(
+                    succeeded, list(running.values()), migrations, failed,
+                )
+
+    if wait:
+        while len(running) > 0:
+            wait_for_tasks(proxmox, running, started, estimate, metrics)
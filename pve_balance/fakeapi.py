@@ -0,0 +1,427 @@
+"""
+Local stand-in for the Proxmox API, to run and time the whole balancer
+without a cluster.
+
+It serves the endpoints the balancer uses over HTTPS, with a self-signed
+certificate created by ``openssl``, for a cluster generated like in the
+benchmark or read from a snapshot. Migrations finish after a duration derived
+from the VM's memory, local disks and CPU usage. Run ``python -m
+pve_balance.fakeapi --help`` for the available options. For tests,
+:class:`FakeProxmox` passes requests to the cluster without a server.
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import monotonic, time
+from urllib.parse import parse_qs, urlsplit
+import json
+import os
+import re
+import shutil
+import ssl
+import subprocess
+import tempfile
+
+from proxmoxer.core import ResourceException
+
+from .cost import migration_bytes
+from .executor import DEFAULT_BANDWIDTH
+
+
+# Storages of the fake cluster, VMs' local disks are on local-lvm
+STORAGES = [
+    {"storage": "local-lvm", "type": "lvmthin"},
+    {"storage": "ceph", "type": "rbd", "shared": 1},
+]
+
+
+class FakeCluster:
+    """
+    State of the fake cluster. Migrations take their estimated bytes divided
+    by the bandwidth, divided by `speedup`.
+    """
+    def __init__(self, hosts, bandwidth=DEFAULT_BANDWIDTH, speedup=1):
+        self.hosts = {host.name: host for host in hosts}
+        self.vms = {vm.id: vm for host in hosts for vm in host.vms}
+        # Memory and CPU the hosts use for themselves
+        self.overhead = {
+            host.name: (
+                host.used_memory - sum(vm.used_memory for vm in host.vms),
+                host.used_cpu - sum(vm.cpu for vm in host.vms),
+            )
+            for host in hosts
+        }
+        self.bandwidth = bandwidth
+        self.speedup = speedup
+        self.tasks = {}
+        self.task_ids = count(1)
+        self.requests = Counter()
+        self.lock = Lock()
+
+    def settle(self):
+        """
+        Moves the VMs of the migrations that finished
+        """
+        now = monotonic()
+        for task in self.tasks.values():
+            if task["end"] <= now and task["status"] == "running":
+                vm = self.vms[task["vmid"]]
+                self.vms[vm.id] = vm._replace(host=task["target"])
+                task["status"] = "stopped"
+
+    def node_vms(self, node):
+        return [vm for vm in self.vms.values() if vm.host == node]
+
+    def used_memory(self, node):
+        return self.overhead[node][0] + sum(
+            vm.used_memory for vm in self.node_vms(node)
+        )
+
+    def cpu(self, node):
+        total_cpu = self.hosts[node].total_cpu
+        if not total_cpu:
+            return 0
+        return (
+            self.overhead[node][1] + sum(vm.cpu for vm in self.node_vms(node))
+        ) / total_cpu
+
+    def node(self, node):
+        host = self.hosts[node]
+        return {
+            "node": node,
+            "status": "online",
+            "mem": self.used_memory(node),
+            "maxmem": host.total_memory,
+            "cpu": self.cpu(node),
+            "maxcpu": host.total_cpu,
+        }
+
+    def vm(self, vm):
+        return {
+            "vmid": vm.id,
+            "name": "vm{}".format(vm.id),
+            "status": "running",
+            "mem": vm.used_memory,
+            "maxmem": vm.total_memory,
+            "cpu": vm.cpu,
+            "cpus": 1,
+            "maxcpu": 1,
+        }
+
+    def migrate(self, node, vmid, target):
+        vm = self.vms.get(vmid)
+        if vm is None or vm.host != node:
+            raise ApiError(500, "VM {} not running on {}".format(vmid, node))
+        if target not in self.hosts or target == node:
+            raise ApiError(400, "Invalid target node {}".format(target))
+        if any(
+            task["vmid"] == vmid and task["status"] == "running"
+            for task in self.tasks.values()
+        ):
+            raise ApiError(500, "VM {} is locked (migrate)".format(vmid))
+
+        task_id = next(self.task_ids)
+        upid = "UPID:{}:{:08X}:00000000:{:08X}:qmigrate:{}:root@pam:".format(
+            node, task_id, int(time()), vmid,
+        )
+        self.tasks[upid] = {
+            "vmid": vmid,
+            "target": target,
+            "status": "running",
+            "end": monotonic()
+            + migration_bytes(vm) / self.bandwidth / self.speedup,
+        }
+        return upid
+
+    def handle(self, method, path, params):
+        """
+        Returns the data of a request to the API path
+        """
+        self.settle()
+        routes = (
+            ("POST", r"access/ticket", self.login),
+            ("GET", r"version", lambda: {"version": "8.0", "release": "8"}),
+            ("GET", r"cluster/resources", self.resources),
+            ("GET", r"storage", lambda: STORAGES),
+            ("GET", r"nodes", lambda: [
+                self.node(node) for node in self.hosts
+            ]),
+            ("GET", r"nodes/([^/]+)/status", self.node_status),
+            ("GET", r"nodes/([^/]+)/rrddata", self.node_rrddata),
+            ("GET", r"nodes/([^/]+)/qemu", lambda node: [
+                self.vm(vm) for vm in self.node_vms(node)
+            ]),
+            ("GET", r"nodes/([^/]+)/qemu/(\d+)/config", self.vm_config),
+            ("GET", r"nodes/([^/]+)/qemu/(\d+)/rrddata", self.vm_rrddata),
+            ("POST", r"nodes/([^/]+)/qemu/(\d+)/migrate", lambda node, vmid:
+                self.migrate(node, int(vmid), params.get("target"))),
+            ("GET", r"nodes/([^/]+)/tasks/([^/]+)/status", self.task_status),
+        )
+        for route_method, pattern, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if match and method == route_method:
+                self.requests[pattern] += 1
+                if match.lastindex and match.group(1) not in self.hosts:
+                    raise ApiError(404, "No such node")
+                return handler(*match.groups())
+        raise ApiError(501, "Method '{} {}' not implemented".format(
+            method, path,
+        ))
+
+    def login(self):
+        return {
+            "ticket": "PVE:root@pam:00000000::fake",
+            "CSRFPreventionToken": "00000000:fake",
+            "username": "root@pam",
+        }
+
+    def resources(self):
+        resources = [
+            dict(self.node(node), type="node", id="node/" + node)
+            for node in self.hosts
+        ]
+        resources.extend(
+            dict(self.vm(vm), type="qemu", node=vm.host,
+                 id="qemu/{}".format(vm.id))
+            for vm in self.vms.values()
+        )
+        return resources
+
+    def node_status(self, node):
+        host = self.hosts[node]
+        return {
+            "memory": {
+                "used": self.used_memory(node),
+                "total": host.total_memory,
+            },
+            "cpu": self.cpu(node),
+            "cpuinfo": {"cpus": host.total_cpu},
+        }
+
+    def rrddata(self, field, value):
+        # Every sample of the last day equals the current usage
+        now = int(time())
+        return [
+            {"time": now - i * 1800, field: value} for i in range(70)
+        ]
+
+    def node_rrddata(self, node):
+        return self.rrddata("memused", self.used_memory(node))
+
+    def vm_config(self, node, vmid):
+        vm = self.vms[int(vmid)]
+        config = {"scsi0": "ceph:vm-{}-disk-0,size=32G".format(vm.id)}
+        if vm.local_disk:
+            config["scsi1"] = "local-lvm:vm-{}-disk-1,size={}".format(
+                vm.id, vm.local_disk,
+            )
+        return config
+
+    def vm_rrddata(self, node, vmid):
+        return self.rrddata("mem", self.vms[int(vmid)].used_memory)
+
+    def task_status(self, node, upid):
+        task = self.tasks.get(upid)
+        if task is None:
+            raise ApiError(404, "No such task")
+        if task["status"] == "running":
+            return {"upid": upid, "status": "running"}
+        return {"upid": upid, "status": "stopped", "exitstatus": "OK"}
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class FakeProxmox:
+    """
+    In-process stand-in for a ``ProxmoxAPI`` client. Requests are passed to
+    `handle(method, path, params)`, e.g. :meth:`FakeCluster.handle`, and an
+    ``ApiError`` is raised as ``ResourceException`` like by the real client.
+    """
+    def __init__(self, handle, path=""):
+        self._handle = handle
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self(name)
+
+    def __call__(self, *segments):
+        path = [self._path] if self._path else []
+        path.extend(str(segment) for segment in segments)
+        return FakeProxmox(self._handle, "/".join(path))
+
+    def _request(self, method, params):
+        try:
+            return self._handle(method, self._path, params)
+        except ApiError as e:
+            raise ResourceException(e.status, str(e), "") from e
+
+    def get(self, **params):
+        return self._request("GET", params)
+
+    def post(self, **params):
+        return self._request("POST", params)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep connections alive like the real API
+    protocol_version = "HTTP/1.1"
+
+    def respond(self, method):
+        url = urlsplit(self.path)
+        params = {
+            key: values[-1] for key, values in parse_qs(url.query).items()
+        }
+        if method == "POST":
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode()
+            params.update(
+                (key, values[-1]) for key, values in parse_qs(body).items()
+            )
+
+        cluster = self.server.cluster
+        try:
+            if not url.path.startswith("/api2/json/"):
+                raise ApiError(404, "Not found")
+            with cluster.lock:
+                data = cluster.handle(
+                    method, url.path[len("/api2/json/"):].strip("/"), params,
+                )
+            status, message, body = 200, None, {"data": data}
+        except ApiError as e:
+            status, message, body = e.status, str(e), {"data": None}
+
+        body = json.dumps(body).encode()
+        self.send_response(status, message)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond("GET")
+
+    def do_POST(self):
+        self.respond("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def certificate(directory):
+    """
+    Creates a self-signed certificate in the directory and returns the paths
+    of the certificate and its key
+    """
+    openssl = shutil.which("openssl")
+    if openssl is None:
+        raise RuntimeError("openssl is needed to create a certificate")
+
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            openssl, "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-subj", "/CN=localhost", "-days", "1",
+            "-keyout", keyfile, "-out", certfile,
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    HTTPS server for a fake cluster on localhost. Use it as a context
+    manager to serve in a background thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, cluster, port=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.cluster = cluster
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        with tempfile.TemporaryDirectory() as directory:
+            context.load_cert_chain(*certificate(directory))
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    @property
+    def host(self):
+        return "127.0.0.1:{}".format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+
+
+def main():
+    import argparse
+
+    from .benchmark import DISTRIBUTIONS, generate_cluster
+    from .snapshot import read_snapshot
+
+    parser = argparse.ArgumentParser(
+        description="Serve a fake Proxmox API for a synthetic cluster."
+    )
+    parser.add_argument("--port", type=int, default=8006)
+    parser.add_argument("--hosts", type=int, default=16)
+    parser.add_argument("--vms", type=int, default=500)
+    parser.add_argument(
+        "--distribution", choices=DISTRIBUTIONS, default="uniform",
+    )
+    parser.add_argument("--skew", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--snapshot", metavar="FILE",
+        help="Serve a cluster recorded with pve_balance --record instead",
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=DEFAULT_BANDWIDTH / 1024 ** 2,
+        metavar="MIB_PER_SEC", help="Bandwidth of migrations in MiB/s",
+    )
+    parser.add_argument(
+        "--speedup", type=float, default=1,
+        help="Factor to speed up migrations by",
+    )
+    args = parser.parse_args()
+
+    if args.snapshot:
+        hosts, _ = read_snapshot(args.snapshot)
+    else:
+        hosts, _ = generate_cluster(
+            args.hosts, args.vms, args.distribution, args.skew,
+            seed=args.seed,
+        )
+
+    cluster = FakeCluster(hosts, args.bandwidth * 1024 ** 2, args.speedup)
+    server = FakeServer(cluster, args.port)
+    print("Serving a fake cluster of {} nodes and {} VMs at {}".format(
+        len(cluster.hosts), len(cluster.vms), server.host,
+    ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for pattern, number in sorted(cluster.requests.items()):
+            print("{:>8} {}".format(number, pattern))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,81 @@
-import logging
 from string import Formatter
+import json
+import logging
+import os
 
 
 default_suffixes = ('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB')
 default_factor = 1024
 
 
-class ByteFormatter(Formatter):
-    def __init__(self, factor=default_factor, suffixes=default_suffixes):
-        self.factor = factor
-        self.suffixes = suffixes
-        self.suffix = None
+class ScaledBytes:
+    """
+    Number of bytes scaled to a unit, formatted with that unit's suffix
+    """
+    __slots__ = ('value', 'suffix')
 
-    def format_field(self, value, format_spec):
-        if self.suffix == 'B':
-            format_spec = '.0f'
-        elif self.suffix:
-            format_spec = '.2f'
+    def __init__(self, value, suffix):
+        self.value = value
+        self.suffix = suffix
 
-        result = super().format_field(value, format_spec)
+    def __format__(self, format_spec):
+        # The format spec aligns the whole string, like for str
+        value = format(self.value, '.0f' if self.suffix == 'B' else '.2f')
+        return format(value + ' ' + self.suffix, format_spec)
 
-        if self.suffix:
-            result += ' ' + self.suffix
-            self.suffix = None
 
-        return result
+class ByteFormatter(Formatter):
+    """
+    Formatter supporting the !b conversion to format bytes with a unit. It
+    keeps no state between calls, so a single instance can be shared by
+    threads.
+    """
+    def __init__(self, factor=default_factor, suffixes=default_suffixes):
+        self.factor = factor
+        self.suffixes = suffixes
 
     def convert_field(self, value, conversion):
         if conversion == 'b':
             for suffix in self.suffixes:
                 if abs(value) < self.factor:
-                    self.suffix = suffix
-                    return value
+                    return ScaledBytes(value, suffix)
                 value /= self.factor
         else:
             return super().convert_field(value, conversion)
 
 
+formatter = ByteFormatter()
+
+
 class Message:
     def __init__(self, fmt, args):
         self.fmt = fmt
         self.args = args
-        self.formatter = ByteFormatter()
 
     def __str__(self):
-        return self.formatter.format(self.fmt, *self.args)
+        return formatter.format(self.fmt, *self.args)
+
+
+class Trace:
+    """
+    Compact buffer of steps, each stored as its format string and arguments.
+    They are only formatted when the trace is converted to a string.
+    """
+    __slots__ = ('steps',)
+
+    def __init__(self):
+        self.steps = []
+
+    def add(self, fmt, *args):
+        self.steps.append((fmt, args))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __str__(self):
+        return '\n'.join(
+            formatter.format(fmt, *args) for fmt, args in self.steps
+        )
 
 
 class ByteLoggerAdapter(logging.LoggerAdapter):
@@ -56,3 +87,40 @@ class ByteLoggerAdapter(logging.LoggerAdapter):
 
 def get_logger(name):
     return ByteLoggerAdapter(logging.getLogger(name), {})
+
+
+logger = get_logger(__name__)
+
+
+def load_cache(path, version, name):
+    """
+    Returns the data of a JSON cache file, or None if there is none, it is
+    corrupt or of another `version`. `name` describes the cache in warnings.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.warning('Ignoring corrupt {} {}: {}', name, path, e)
+        return None
+
+    if not isinstance(data, dict):
+        logger.warning('Ignoring corrupt {} {}', name, path)
+        return None
+    if data.get('version') != version:
+        return None
+    return data
+
+
+def save_cache(path, version, **data):
+    """
+    Stores the data as a JSON cache file of the `version`
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Replace the cache atomically, so an interrupted run can't corrupt it
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(data, version=version), f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,217 @@
+"""
+Memory usage of hosts and VMs over time, from the RRD data of Proxmox.
+
+Planning on a statistic of the memory usage over a window, like its average
+or 95th percentile, keeps the balancer from chasing short spikes. Samples are
+kept in an on-disk cache, so later runs only fetch the samples added since.
+"""
+from operator import itemgetter
+import os
+import re
+import time
+
+from .helper import get_logger, load_cache, save_cache
+from .inventory import map_concurrently, pool_connections
+from .model import update_vm
+
+
+logger = get_logger(__name__)
+
+STATISTICS = re.compile(r"^(current|average|p(\d+(?:\.\d+)?))$")
+DEFAULT_CACHE = os.path.join("~", ".cache", "pve-balance", "rrd.json")
+CACHE_VERSION = 1
+
+# Timeframes of the RRD data and the seconds between their samples. Each
+# timeframe holds 70 samples.
+TIMEFRAMES = (
+    ("hour", 60),
+    ("day", 30 * 60),
+    ("week", 3 * 60 * 60),
+    ("month", 12 * 60 * 60),
+    ("year", 7 * 24 * 60 * 60),
+)
+TIMEFRAME_SAMPLES = 70
+
+
+def parse_statistic(statistic):
+    """
+    Validates a statistic of memory usage: "current", "average" or a
+    percentile like "p95"
+    """
+    match = STATISTICS.match(statistic)
+    if not match or (match.group(2) and float(match.group(2)) > 100):
+        raise ValueError("Invalid statistic {!r}".format(statistic))
+    return statistic
+
+
+def timeframe(seconds):
+    """
+    Returns the shortest timeframe and its resolution covering the last
+    `seconds`
+    """
+    for name, step in TIMEFRAMES:
+        if step * TIMEFRAME_SAMPLES >= seconds:
+            return name, step
+    return TIMEFRAMES[-1]
+
+
+def summarize(samples, statistic):
+    """
+    Returns the statistic of samples given as (time, step, value), weighing
+    each sample by the seconds it covers
+    """
+    total = sum(step for _, step, _ in samples)
+    if statistic == "average":
+        return sum(step * value for _, step, value in samples) / total
+
+    limit = float(statistic[1:]) / 100 * total
+    covered = 0
+    for _, step, value in sorted(samples, key=itemgetter(2)):
+        covered += step
+        if covered >= limit:
+            return value
+    return value
+
+
+class RRDCache:
+    """
+    Samples of the memory usage of nodes and VMs, stored as JSON. Each series
+    remembers since when it covers the usage, so only newer samples need to
+    be fetched.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.series = {}
+
+    @classmethod
+    def load(cls, path):
+        cache = cls(path)
+        data = load_cache(path, CACHE_VERSION, "RRD cache")
+        if data is not None:
+            cache.series = data["series"]
+        return cache
+
+    def save(self):
+        save_cache(self.path, CACHE_VERSION, series=self.series)
+
+    def since(self, key, start):
+        """
+        Returns the time of the newest sample of the series if the series
+        covers everything since `start`, otherwise None
+        """
+        series = self.series.get(key)
+        if series is None or series["from"] > start or not series["samples"]:
+            return None
+        return series["samples"][-1][0]
+
+    def add(self, key, covered_from, samples):
+        """
+        Adds samples newer than those of the series. If the samples cover an
+        earlier time than the series, they replace it.
+        """
+        series = self.series.get(key)
+        if series is None or covered_from < series["from"]:
+            series = self.series[key] = {"from": covered_from, "samples": []}
+
+        newest = series["samples"][-1][0] if series["samples"] else None
+        series["samples"].extend(
+            sample for sample in samples
+            if newest is None or sample[0] > newest
+        )
+
+    def samples(self, key, start):
+        series = self.series.get(key, {"samples": []})
+        return [sample for sample in series["samples"] if sample[0] >= start]
+
+    def prune(self, start):
+        """
+        Drops samples older than `start` and series without samples left
+        """
+        for key in list(self.series):
+            series = self.series[key]
+            series["from"] = max(series["from"], start)
+            series["samples"] = [
+                sample for sample in series["samples"] if sample[0] >= start
+            ]
+            if not series["samples"]:
+                del self.series[key]
+
+
+def add_memory_history(proxmox, hosts, statistic, window, cache_path=None,
+                       concurrency=8, now=None):
+    """
+    Replaces the used memory of hosts and their VMs by the statistic of their
+    memory usage over the last `window` seconds. The RRD data of up to
+    `concurrency` nodes and VMs is fetched at once. Hosts and VMs without
+    data keep their current usage.
+    """
+    if statistic == "current":
+        return
+
+    if now is None:
+        now = time.time()
+    start = now - window
+    cache = RRDCache.load(cache_path) if cache_path else RRDCache()
+
+    # Nodes report their used memory as "memused", VMs as "mem"
+    series = {"node/" + host.name: (host.name, None) for host in hosts}
+    series.update(
+        ("qemu/{}".format(vm.id), (host.name, vm.id))
+        for host in hosts for vm in host.vms
+    )
+
+    def fetch(key):
+        node, vmid = series[key]
+        since = cache.since(key, start)
+        name, step = timeframe(now - (start if since is None else since))
+        resource = proxmox.nodes(node)
+        if vmid is not None:
+            resource = resource.qemu(vmid)
+        return step, resource.rrddata.get(timeframe=name, cf="AVERAGE")
+
+    pool_connections(proxmox, concurrency)
+    fetched = 0
+    for key, result in map_concurrently(fetch, list(series), concurrency):
+        if isinstance(result, Exception):
+            logger.warning("Could not get RRD data of {}: {}", key, result)
+            continue
+
+        step, rows = result
+        field = "mem" if key.startswith("qemu/") else "memused"
+        cache.add(
+            key,
+            min((row["time"] for row in rows), default=now),
+            [
+                [row["time"], step, row[field]]
+                for row in sorted(rows, key=itemgetter("time"))
+                if row.get(field) is not None
+            ],
+        )
+        fetched += 1
+
+    logger.info(
+        "Fetched RRD data of {} nodes and VMs, using the {} memory usage of "
+        "the last {:.0f}h",
+        fetched,
+        statistic,
+        window / 3600,
+    )
+
+    def memory(key, current):
+        samples = cache.samples(key, start)
+        if not samples:
+            return current
+        return int(summarize(samples, statistic))
+
+    for host in hosts:
+        host.used_memory = memory("node/" + host.name, host.used_memory)
+        host.vms = [
+            update_vm(vm, used_memory=memory(
+                "qemu/{}".format(vm.id), vm.used_memory,
+            ))
+            for vm in host.vms
+        ]
+
+    if cache_path:
+        cache.prune(start)
+        cache.save()
@@ -0,0 +1,253 @@
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import re
+
+from proxmoxer.core import ResourceException
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+
+from .helper import get_logger
+from .model import Host, VMTable, update_vm
+
+
+logger = get_logger(__name__)
+
+METHODS = ("resources", "nodes")
+
+# Storage types whose volumes are accessible from all hosts, even if they are
+# not marked as shared
+SHARED_STORAGE_TYPES = {
+    "cephfs", "cifs", "glusterfs", "iscsi", "iscsidirect", "nfs", "rbd",
+}
+
+DISK_KEY = re.compile(r"^(ide|sata|scsi|virtio|efidisk|tpmstate)\d+$")
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def pool_connections(proxmox, size):
+    """
+    Lets up to `size` threads share the keep-alive connections of the API
+    session. Does nothing for backends not using HTTP.
+    """
+    session = getattr(proxmox, "_store", {}).get("session")
+    if hasattr(session, "mount"):
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        session.mount("https://", adapter)
+
+
+def map_concurrently(func, items, concurrency):
+    """
+    Calls `func` for all items using up to `concurrency` threads and yields
+    pairs of item and result, in the order of the items. If a call fails due
+    to an API or connection error, the exception is yielded as result.
+    """
+    def call(item):
+        try:
+            return func(item)
+        except (ResourceException, RequestException) as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from zip(items, executor.map(call, items))
+
+
+def inventory_from_resources(proxmox):
+    """
+    Builds the hosts and their running VMs from a single request of the
+    cluster's resources
+    """
+    nodes = []
+    vms = {}
+    table = VMTable()
+    for resource in proxmox.cluster.resources.get():
+        if resource["type"] == "node":
+            if resource.get("status") != "online":
+                logger.warning(
+                    "Ignoring node {} with status {}",
+                    resource["node"],
+                    resource.get("status"),
+                )
+                continue
+            nodes.append(resource)
+        elif resource["type"] == "qemu":
+            if resource["status"] != "running":
+                continue
+
+            vms.setdefault(resource["node"], []).append(table.append(
+                id=resource["vmid"],
+                used_memory=resource["mem"],
+                total_memory=resource["maxmem"],
+                host=resource["node"],
+                cpu=resource.get("cpu", 0) * resource.get("maxcpu", 0),
+            ))
+
+    return [
+        Host(
+            name=node["node"],
+            used_memory=node["mem"],
+            total_memory=node["maxmem"],
+            vms=vms.get(node["node"], []),
+            used_cpu=node.get("cpu", 0) * node.get("maxcpu", 0),
+            total_cpu=node.get("maxcpu", 0),
+        )
+        for node in sorted(nodes, key=itemgetter("node"))
+    ]
+
+
+def inventory_from_nodes(proxmox, concurrency=8):
+    """
+    Builds the hosts and their running VMs by querying each node on its own,
+    up to `concurrency` nodes at once. Nodes that aren't online are ignored.
+    If any other node fails to list its VMs, its error is raised, as leaving
+    the node out would shift the average memory usage the other nodes are
+    balanced towards.
+    """
+    def get_vms(node):
+        return proxmox.nodes(node["node"]).qemu.get(full=1)
+
+    nodes = []
+    for node in proxmox.nodes.get():
+        if node.get("status") != "online":
+            logger.warning(
+                "Ignoring node {} with status {}",
+                node["node"],
+                node.get("status"),
+            )
+            continue
+        nodes.append(node)
+    pool_connections(proxmox, concurrency)
+
+    hosts = []
+    errors = []
+    table = VMTable()
+    for node, node_vms in map_concurrently(get_vms, nodes, concurrency):
+        if isinstance(node_vms, Exception):
+            logger.error(
+                "Node {} failed to list its VMs: {}",
+                node["node"],
+                node_vms,
+            )
+            errors.append(node_vms)
+            continue
+
+        vms = []
+        for vm in node_vms:
+            if vm["status"] != "running":
+                continue
+
+            vms.append(table.append(
+                id=vm["vmid"],
+                used_memory=vm["mem"],
+                total_memory=vm["maxmem"],
+                host=node["node"],
+                cpu=vm.get("cpu", 0) * vm.get("cpus", 0),
+            ))
+        hosts.append(Host(
+            name=node["node"],
+            used_memory=node["mem"],
+            total_memory=node["maxmem"],
+            vms=vms,
+            used_cpu=node.get("cpu", 0) * node.get("maxcpu", 0),
+            total_cpu=node.get("maxcpu", 0),
+        ))
+
+    if errors:
+        raise errors[0]
+    return hosts
+
+
+def get_inventory(proxmox, method="resources", concurrency=8):
+    """
+    Returns the hosts of the cluster. Unless the per-node method is asked
+    for, the cluster's resources are used, falling back to querying each
+    node if that fails.
+    """
+    if method == "resources":
+        try:
+            return inventory_from_resources(proxmox)
+        except (ResourceException, RequestException) as e:
+            logger.warning(
+                "Could not list cluster resources, querying each node "
+                "instead: {}",
+                e,
+            )
+    elif method != "nodes":
+        raise ValueError("Unknown inventory method {!r}".format(method))
+
+    return inventory_from_nodes(proxmox, concurrency)
+
+
+def parse_size(size):
+    """
+    Parses a disk size like "32G" into bytes
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)", size)
+    if not match:
+        raise ValueError("Invalid size {!r}".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def local_disk_size(config, local_storages):
+    """
+    Returns the total size of the disks in the VM configuration that are on
+    one of the local storages
+    """
+    total = 0
+    for key, value in config.items():
+        if not DISK_KEY.match(key):
+            continue
+
+        volume, *options = value.split(",")
+        options = dict(
+            option.split("=", 1) for option in options if "=" in option
+        )
+        if options.get("media") == "cdrom" or ":" not in volume:
+            continue
+        if volume.split(":", 1)[0] in local_storages and "size" in options:
+            total += parse_size(options["size"])
+
+    return total
+
+
+def add_local_disks(proxmox, hosts, concurrency=8, sizes=None):
+    """
+    Fills in the size of the VMs' disks on local storage, which have to be
+    copied when migrating them. Queries the configurations of up to
+    `concurrency` VMs at once.
+
+    If given, the `sizes` dict maps VM IDs to known sizes. Only the
+    configurations of other VMs are queried, and the dict is updated.
+    """
+    if sizes is None:
+        sizes = {}
+
+    local_storages = {
+        storage["storage"] for storage in proxmox.storage.get()
+        if not storage.get("shared")
+        and storage["type"] not in SHARED_STORAGE_TYPES
+    }
+
+    def get_config(vm):
+        return proxmox.nodes(vm.host).qemu(vm.id).config.get()
+
+    vms = [vm for host in hosts for vm in host.vms]
+    unknown = [vm for vm in vms if vm.id not in sizes]
+    for vm, config in map_concurrently(get_config, unknown, concurrency):
+        if isinstance(config, Exception):
+            logger.warning(
+                "Could not get configuration of VM {}: {}",
+                vm.id,
+                config,
+            )
+        else:
+            sizes[vm.id] = local_disk_size(config, local_storages)
+
+    # Forget VMs that are gone
+    for vmid in set(sizes).difference(vm.id for vm in vms):
+        del sizes[vmid]
+
+    for host in hosts:
+        host.vms = [
+            update_vm(vm, local_disk=sizes[vm.id]) if vm.id in sizes else vm
+            for vm in host.vms
+        ]
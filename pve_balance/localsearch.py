@@ -0,0 +1,245 @@
+"""
+Improving a plan of migrations by local search.
+
+The planning engines migrate one VM at a time and stop once no single
+migration between the most imbalanced hosts helps, which may leave more
+imbalance than needed, especially with a few big VMs. Starting from their
+plan, the local search exchanges VMs between the most imbalanced host and
+the others: it moves single VMs, swaps two VMs and trades two VMs for one.
+Each exchange lowers the imbalance of the hosts involved, so the current
+plan is always the best one found. It is returned once the imbalance is
+below the threshold, no exchange helps or the time budget is spent.
+"""
+from collections import Counter
+from itertools import islice
+from time import perf_counter
+
+from .algorithm import (
+    set_cpu_imbalance,
+    set_memory_imbalance,
+    shift_imbalance,
+)
+from .helper import get_logger
+from .model import Migration, SortedVMs
+
+logger = get_logger(__name__)
+
+# Number of VMs closest to the wanted amount of memory tried for each VM of
+# an exchange. Balancing memory only, the closest one is the best.
+NEIGHBOURS = 3
+
+
+def load(host):
+    return max(abs(host.memory_imbalance), abs(host.cpu_imbalance))
+
+
+def closest(host, memory, skip=(), count=NEIGHBOURS):
+    """
+    Returns up to `count` VMs of the host whose used memory is closest to
+    `memory`, leaving out the VMs to skip
+    """
+    return islice(
+        (vm for vm in host.sorted_vms.closest(memory) if vm not in skip),
+        count,
+    )
+
+
+def exchanges(source, target, delta, trades, count=NEIGHBOURS):
+    """
+    Yields exchanges of VMs between the hosts moving about `delta` bytes of
+    memory from the source to the target host, as tuples of the VMs
+    migrating to the target and the VMs migrating back. Trades of two VMs
+    for one are only yielded if `trades` is true, as there are many more.
+    """
+    for vm in closest(source, delta, count=count):
+        yield (vm,), ()
+
+    for back in target.sorted_vms:
+        for vm in closest(source, delta + back.used_memory, count=count):
+            yield (vm,), (back,)
+
+    if not trades:
+        return
+
+    for back in target.sorted_vms:
+        for first in source.sorted_vms:
+            for second in closest(
+                source, delta + back.used_memory - first.used_memory,
+                (first,), count,
+            ):
+                yield (first, second), (back,)
+
+    for vm in source.sorted_vms:
+        for first in target.sorted_vms:
+            for second in closest(
+                target, vm.used_memory - delta - first.used_memory,
+                (first,), count,
+            ):
+                yield (vm,), (first, second)
+
+
+def improve_migrations(hosts, exclude, migrations, threshold=1024**3,
+                       time_budget=1, cpu_weight=0, stats=None):
+    """
+    Improves the migrations planned for the hosts by exchanging VMs between
+    them, until the imbalance is below the threshold, no exchange lowers it
+    or `time_budget` seconds passed, and returns the best migrations found.
+    If given, the `stats` Counter is updated with the number of exchanges
+    evaluated and made by kind.
+    """
+    deadline = perf_counter() + time_budget
+    if stats is None:
+        stats = Counter()
+
+    if not hosts:
+        return list(migrations)
+
+    hosts = list(hosts)
+    exclude = set(exclude)
+
+    set_memory_imbalance(hosts, exclude)
+    cpu_factor = set_cpu_imbalance(hosts, exclude, cpu_weight)
+    count = NEIGHBOURS if cpu_factor else 1
+
+    for host in hosts:
+        host.sorted_vms = SortedVMs(vm for vm in host.vms if vm.used_memory)
+
+    # Maps each VM to migrate to its target host name, in order of the plan
+    planned = {}
+
+    def migrate(vm, source_host, target_host):
+        source_host.sorted_vms.remove(vm)
+        target_host.sorted_vms.add(vm)
+        shift_imbalance(vm, source_host, target_host, cpu_factor)
+        if target_host.name == vm.host:
+            del planned[vm]
+        else:
+            planned[vm] = target_host.name
+
+    by_name = {host.name: host for host in hosts}
+    for migration in migrations:
+        migrate(
+            migration.vm,
+            by_name[migration.vm.host],
+            by_name[migration.target_host],
+        )
+
+    def score(source_host, target_host, vms, back):
+        """
+        Returns the greatest imbalance of both hosts after the exchange,
+        the change of the number of migrations and the summed imbalance
+        """
+        memory = sum(vm.used_memory for vm in vms)
+        memory -= sum(vm.used_memory for vm in back)
+        cpu = cpu_factor * (
+            sum(vm.cpu for vm in vms) - sum(vm.cpu for vm in back)
+        )
+        imbalances = (
+            abs(source_host.memory_imbalance + memory),
+            abs(source_host.cpu_imbalance + cpu),
+            abs(target_host.memory_imbalance - memory),
+            abs(target_host.cpu_imbalance - cpu),
+        )
+        added = (
+            sum(vm.host == source_host.name for vm in vms)
+            + sum(vm.host == target_host.name for vm in back)
+            - sum(vm.host == target_host.name for vm in vms)
+            - sum(vm.host == source_host.name for vm in back)
+        )
+        return max(imbalances), added, sum(imbalances)
+
+    def best_exchange(host, trades):
+        """
+        Returns the best exchange between the host and another one lowering
+        the greater imbalance of both, and whether the time ran out while
+        looking for it
+        """
+        def distance(other):
+            return abs(other.memory_imbalance - host.memory_imbalance) + abs(
+                other.cpu_imbalance - host.cpu_imbalance
+            )
+
+        best = None
+        for other in sorted(hosts, key=distance, reverse=True):
+            limit = max(load(host), load(other))
+            for source_host, target_host in ((host, other), (other, host)):
+                if source_host is target_host or target_host in exclude:
+                    continue
+
+                delta = (
+                    target_host.memory_imbalance
+                    - source_host.memory_imbalance
+                ) / 2
+                if delta <= 0 and not cpu_factor:
+                    continue
+
+                candidates = exchanges(
+                    source_host, target_host, delta,
+                    trades and source_host not in exclude, count,
+                )
+                if source_host in exclude:
+                    # Nothing may migrate back to an excluded host
+                    candidates = islice(candidates, count)
+
+                for vms, back in candidates:
+                    if perf_counter() > deadline:
+                        return best, True
+                    stats["exchanges_evaluated"] += 1
+                    key = score(source_host, target_host, vms, back)
+                    if key[0] < limit and (best is None or key < best[0]):
+                        best = key, source_host, target_host, vms, back
+
+        return best, False
+
+    start_imbalance = remaining = max(map(load, hosts))
+    planned_before = len(planned)
+    timed_out = False
+    while remaining > threshold and not timed_out:
+        # Improve the most imbalanced host that can be improved. Some can't,
+        # like excluded hosts using memory for themselves.
+        best = None
+        for trades in (False, True):
+            for host in sorted(hosts, key=load, reverse=True):
+                if load(host) <= threshold or timed_out:
+                    break
+                best, timed_out = best_exchange(host, trades)
+                if best is not None:
+                    break
+            if best is not None or timed_out:
+                break
+        if best is None:
+            break
+
+        _, source_host, target_host, vms, back = best
+        kind = "trade" if len(vms) + len(back) > 2 else (
+            "swap" if back else "move"
+        )
+        stats["exchanges_" + kind] += 1
+        logger.info(
+            "Exchanging VMs {} of host {} for VMs {} of host {}",
+            [vm.id for vm in vms],
+            source_host.name,
+            [vm.id for vm in back],
+            target_host.name,
+        )
+        for vm in vms:
+            migrate(vm, source_host, target_host)
+        for vm in back:
+            migrate(vm, target_host, source_host)
+        remaining = max(map(load, hosts))
+
+    if timed_out:
+        logger.info(
+            "Local search ran out of its time budget of {:.1f}s",
+            time_budget,
+        )
+    logger.info(
+        "Local search reduced the remaining imbalance from {!b} to {!b}, "
+        "planning {} instead of {} migrations",
+        start_imbalance,
+        remaining,
+        len(planned),
+        planned_before,
+    )
+
+    return [Migration(vm, target) for vm, target in planned.items()]
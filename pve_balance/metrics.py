@@ -0,0 +1,158 @@
+"""
+Figures about a balancing run: time spent per phase, API requests, planner
+operations, migration durations and failed migrations.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter, time
+import json
+import os
+
+
+class Metrics:
+    """
+    Collects the figures of a run. The planner counters are passed to the
+    planner as its `stats`, API requests are counted by hooking into the
+    requests session.
+    """
+    def __init__(self):
+        self.phases = Counter()
+        self.api_requests = Counter()
+        self.api_errors = 0
+        self.planner = Counter()
+        self.migrations = []
+        self.failed_migrations = []
+        self.lock = Lock()
+        self.hooks = []
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the time spent in it to the named phase
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += perf_counter() - start
+
+    def count_requests(self, proxmox):
+        """
+        Counts the requests of the API session by method, and the failed
+        ones. Does nothing for backends not using HTTP.
+        """
+        def count(response, *args, **kwargs):
+            with self.lock:
+                self.api_requests[response.request.method] += 1
+                if not response.ok:
+                    self.api_errors += 1
+
+        session = getattr(proxmox, "_store", {}).get("session")
+        if hasattr(session, "hooks"):
+            session.hooks["response"].append(count)
+            self.hooks.append((session, count))
+
+    def close(self):
+        """
+        Stops counting requests, as the session may outlive the run
+        """
+        for session, hook in self.hooks:
+            session.hooks["response"].remove(hook)
+        self.hooks = []
+
+    def migration(self, migration, duration):
+        self.migrations.append({
+            "vm": migration.vm.id,
+            "source": migration.vm.host,
+            "target": migration.target_host,
+            "seconds": duration,
+        })
+
+    def failed_migration(self, migration):
+        self.failed_migrations.append({
+            "vm": migration.vm.id,
+            "source": migration.vm.host,
+            "target": migration.target_host,
+        })
+
+    def as_dict(self):
+        return {
+            "phases": dict(self.phases),
+            "api_requests": dict(self.api_requests),
+            "api_errors": self.api_errors,
+            "planner": dict(self.planner),
+            "migrations": self.migrations,
+            "failed_migrations": self.failed_migrations,
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text format
+        """
+        lines = []
+
+        def metric(name, help, samples):
+            name = "pve_balance_" + name
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(name, labels, value))
+
+        def labeled(label, counter):
+            return [
+                ('{{{}="{}"}}'.format(label, key), value)
+                for key, value in sorted(counter.items())
+            ]
+
+        durations = [migration["seconds"] for migration in self.migrations]
+        metric(
+            "phase_seconds", "Time spent per phase of the last run",
+            labeled("phase", self.phases),
+        )
+        metric(
+            "api_requests", "Requests to the Proxmox API in the last run",
+            labeled("method", self.api_requests),
+        )
+        metric(
+            "api_errors", "Failed requests to the Proxmox API in the last run",
+            [("", self.api_errors)],
+        )
+        metric(
+            "planner_operations", "Operations of the planner in the last run",
+            labeled("operation", self.planner),
+        )
+        metric(
+            "migrations", "Migrations finished in the last run",
+            [("", len(durations))],
+        )
+        metric(
+            "migrations_failed", "Migrations failed in the last run",
+            [("", len(self.failed_migrations))],
+        )
+        metric(
+            "migration_seconds_sum", "Total duration of finished migrations",
+            [("", sum(durations))],
+        )
+        metric(
+            "migration_seconds_max", "Longest duration of finished migrations",
+            [("", max(durations, default=0))],
+        )
+        metric(
+            "last_run_timestamp_seconds", "When the last run ended",
+            [("", time())],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics to a textfile for the node exporter. The file is
+        replaced atomically, so the exporter never reads a partial file.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
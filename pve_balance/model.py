@@ -1,17 +1,247 @@
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
+from operator import attrgetter
 
 
-VM = namedtuple("VM", ("id", "used_memory", "total_memory", "host"))
+# cpu is the number of CPU cores the VM keeps busy, local_disk the size of
+# its disks on storage that is not shared between the hosts
+VM = namedtuple(
+    "VM",
+    ("id", "used_memory", "total_memory", "host", "cpu", "local_disk"),
+    defaults=(0, 0),
+)
 Migration = namedtuple("Migration", ("vm", "target_host"))
 
 
+class VMTable:
+    """
+    Columnar store of VMs for large inventories. Every field is kept in an
+    array and the host as an index into the list of host names, so a VM
+    takes a few machine words instead of a tuple of Python objects. VMs are
+    accessed through :class:`VMView` objects.
+    """
+    __slots__ = (
+        "id", "used_memory", "total_memory", "host", "cpu", "local_disk",
+        "host_names", "host_indexes",
+    )
+
+    def __init__(self):
+        self.id = array("q")
+        self.used_memory = array("q")
+        self.total_memory = array("q")
+        self.host = array("l")
+        self.cpu = array("d")
+        self.local_disk = array("q")
+        self.host_names = []
+        self.host_indexes = {}
+
+    def __len__(self):
+        return len(self.id)
+
+    def __iter__(self):
+        return map(self.view, range(len(self.id)))
+
+    def view(self, index):
+        return VMView(self, index)
+
+    def append(self, id, used_memory, total_memory, host, cpu=0,
+               local_disk=0):
+        """
+        Adds a VM and returns a view of it
+        """
+        host_index = self.host_indexes.get(host)
+        if host_index is None:
+            host_index = self.host_indexes[host] = len(self.host_names)
+            self.host_names.append(host)
+
+        self.id.append(id)
+        self.used_memory.append(used_memory)
+        self.total_memory.append(total_memory)
+        self.host.append(host_index)
+        self.cpu.append(cpu)
+        self.local_disk.append(local_disk)
+        return VMView(self, len(self.id) - 1)
+
+    def update(self, index, **changes):
+        """
+        Changes fields of the VM at the index in place
+        """
+        for field, value in changes.items():
+            if field == "host":
+                if value not in self.host_indexes:
+                    self.host_indexes[value] = len(self.host_names)
+                    self.host_names.append(value)
+                value = self.host_indexes[value]
+            getattr(self, field)[index] = value
+
+
+class VMView:
+    """
+    A VM stored in a :class:`VMTable`. Views behave like :data:`VM` tuples:
+    they have the same attributes and iterate over the same fields. As they
+    can be changed in place by :func:`update_vm`, they are compared and
+    hashed by their table and index, never equal to a VM tuple. Compare
+    their fields instead. :meth:`_replace` returns a new :data:`VM`.
+    """
+    __slots__ = ("table", "index")
+    _fields = VM._fields
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    # The columns are spelled out, as the planners read them a lot
+
+    @property
+    def id(self):
+        return self.table.id[self.index]
+
+    @property
+    def used_memory(self):
+        return self.table.used_memory[self.index]
+
+    @property
+    def total_memory(self):
+        return self.table.total_memory[self.index]
+
+    @property
+    def cpu(self):
+        return self.table.cpu[self.index]
+
+    @property
+    def local_disk(self):
+        return self.table.local_disk[self.index]
+
+    @property
+    def host(self):
+        table = self.table
+        return table.host_names[table.host[self.index]]
+
+    def _astuple(self):
+        table, index = self.table, self.index
+        return (
+            table.id[index],
+            table.used_memory[index],
+            table.total_memory[index],
+            table.host_names[table.host[index]],
+            table.cpu[index],
+            table.local_disk[index],
+        )
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        return self._astuple()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, VMView):
+            return other.index == self.index and other.table is self.table
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.table), self.index))
+
+    def __repr__(self):
+        return repr(VM(*self._astuple()))
+
+    def __reduce__(self):
+        return VM, self._astuple()
+
+    def _asdict(self):
+        return dict(zip(self._fields, self._astuple()))
+
+    def _replace(self, **changes):
+        return VM(*self._astuple())._replace(**changes)
+
+
+def update_vm(vm, **changes):
+    """
+    Returns the VM with the fields changed. Views of a :class:`VMTable` are
+    changed in place, keeping the VMs in columnar storage.
+    """
+    if isinstance(vm, VMView):
+        vm.table.update(vm.index, **changes)
+        return vm
+    return vm._replace(**changes)
+
+
+class SortedVMs:
+    """
+    VMs sorted by used memory. VMs with the same amount of used memory keep
+    their original order.
+    """
+
+    def __init__(self, vms):
+        self.vms = sorted(vms, key=attrgetter("used_memory"))
+        self.keys = [vm.used_memory for vm in self.vms]
+
+    def __len__(self):
+        return len(self.vms)
+
+    def __iter__(self):
+        return iter(self.vms)
+
+    def add(self, vm):
+        """
+        Inserts the VM after the VMs with the same amount of used memory
+        """
+        i = bisect_right(self.keys, vm.used_memory)
+        self.vms.insert(i, vm)
+        self.keys.insert(i, vm.used_memory)
+
+    def remove(self, vm):
+        i = bisect_left(self.keys, vm.used_memory)
+        while self.vms[i] != vm:
+            i += 1
+        del self.vms[i]
+        del self.keys[i]
+
+    def closest(self, memory, limit=None):
+        """
+        Yields the VMs in order of their distance of used memory to `memory`,
+        skipping VMs using more than `limit`. In case of a tie, VMs with less
+        memory come first.
+        """
+        keys, vms = self.keys, self.vms
+        end = len(keys) if limit is None else bisect_right(keys, limit)
+        left = right = min(bisect_left(keys, memory), end)
+
+        while left > 0 or right < end:
+            if right < end and (
+                left == 0 or keys[right] - memory < memory - keys[left - 1]
+            ):
+                yield vms[right]
+                right += 1
+            else:
+                # Yield VMs of equal memory in their original order
+                start = bisect_left(keys, keys[left - 1], 0, left)
+                yield from vms[start:left]
+                left = start
+
+
 class Host:
-    def __init__(self, name, used_memory, total_memory, vms):
+    __slots__ = (
+        "name", "used_memory", "total_memory", "vms", "used_cpu", "total_cpu",
+        "memory_imbalance", "cpu_imbalance", "imbalance", "sorted_vms",
+    )
+
+    def __init__(self, name, used_memory, total_memory, vms, used_cpu=0,
+                 total_cpu=0):
         self.name = name
         self.used_memory = used_memory
         self.total_memory = total_memory
         self.vms = vms
+        self.used_cpu = used_cpu
+        self.total_cpu = total_cpu
         self.memory_imbalance = None
+        self.cpu_imbalance = None
+        self.imbalance = None
+        self.sorted_vms = None
 
     def __repr__(self):
         return "Host(name={self.name!r})".format(self=self)
@@ -0,0 +1,150 @@
+"""
+Reusing plans for a cluster that didn't change since they were made.
+
+Run every few minutes, the balancer mostly finds the cluster in the same
+shape and would plan the same migrations again. Plans are cached on disk by
+a fingerprint of what they were planned for: the hosts, the VMs with their
+memory usage rounded to buckets and their local disks, the excluded hosts,
+the threshold and the planning options.
+"""
+from hashlib import sha256
+from operator import attrgetter
+import json
+import os
+import time
+
+from .helper import load_cache, save_cache
+from .model import Migration
+
+
+DEFAULT_PLAN_CACHE = os.path.join("~", ".cache", "pve-balance", "plans.json")
+PLAN_CACHE_VERSION = 1
+
+# Memory usage is rounded down to multiples of this many bytes, so small
+# fluctuations don't change the fingerprint
+MEMORY_BUCKET = 256 * 1024 ** 2
+
+# CPU usage is rounded to multiples of this many cores if it is balanced
+CPU_BUCKET = 0.5
+
+
+def fingerprint(hosts, exclude, threshold=1024**3, cpu_weight=0,
+                memory_bucket=MEMORY_BUCKET, **options):
+    """
+    Returns a hex digest of the hosts, their VMs and memory usage rounded to
+    `memory_bucket`, the VMs' local disks, the excluded hosts, the threshold
+    and further planning options given as keyword arguments. CPU usage is
+    only taken into account with a `cpu_weight`.
+    """
+    def memory(value):
+        return int(value // memory_bucket)
+
+    def cpu(value):
+        return round(value / CPU_BUCKET) if cpu_weight else 0
+
+    state = {
+        "hosts": [
+            [
+                host.name,
+                host.total_memory,
+                memory(host.used_memory),
+                host.total_cpu,
+                cpu(host.used_cpu),
+                sorted(
+                    [
+                        vm.id, memory(vm.used_memory), cpu(vm.cpu),
+                        vm.local_disk,
+                    ]
+                    for vm in host.vms
+                ),
+            ]
+            for host in sorted(hosts, key=attrgetter("name"))
+        ],
+        "exclude": sorted(host.name for host in exclude),
+        "threshold": threshold,
+        "cpu_weight": cpu_weight,
+        "options": options,
+    }
+    return sha256(
+        json.dumps(state, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+class PlanCache:
+    """
+    Plans stored as JSON by the fingerprint of the cluster state they were
+    made for. Plans older than `max_age` seconds are dropped, and the least
+    recently used ones beyond `max_entries`.
+    """
+    def __init__(self, path=None, max_entries=32, max_age=3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = {}
+
+    @classmethod
+    def load(cls, path, max_entries=32, max_age=3600):
+        cache = cls(path, max_entries, max_age)
+        data = load_cache(path, PLAN_CACHE_VERSION, "plan cache")
+        if data is not None:
+            cache.entries = data["entries"]
+        return cache
+
+    def save(self):
+        save_cache(self.path, PLAN_CACHE_VERSION, entries=self.entries)
+
+    def get(self, key, hosts, now=None):
+        """
+        Returns the cached migrations for the fingerprint with the VMs of the
+        hosts, or None if there are none or they are outdated
+        """
+        if now is None:
+            now = time.time()
+
+        entry = self.entries.get(key)
+        if entry is None or now - entry["created"] > self.max_age:
+            return None
+
+        vms = {vm.id: vm for host in hosts for vm in host.vms}
+        try:
+            migrations = [
+                Migration(vms[vmid], target)
+                for vmid, target in entry["migrations"]
+            ]
+        except KeyError:
+            return None
+
+        entry["used"] = now
+        return migrations
+
+    def put(self, key, migrations, now=None):
+        if now is None:
+            now = time.time()
+
+        self.entries[key] = {
+            "created": now,
+            "used": now,
+            "migrations": [
+                [migration.vm.id, migration.target_host]
+                for migration in migrations
+            ],
+        }
+        self.evict(now)
+
+    def evict(self, now=None):
+        """
+        Drops outdated plans and the least recently used ones beyond the
+        maximum number of entries
+        """
+        if now is None:
+            now = time.time()
+
+        entries = sorted(
+            (
+                item for item in self.entries.items()
+                if now - item[1]["created"] <= self.max_age
+            ),
+            key=lambda item: item[1]["used"],
+            reverse=True,
+        )
+        self.entries = dict(entries[:self.max_entries])
@@ -0,0 +1,216 @@
+"""
+Keeping the remaining migrations up to date while they are executed.
+
+A full rebalance can take hours, while VMs grow or shrink and operators
+migrate VMs by hand. After migrations finished, the hosts of the remaining
+plan are queried again and the remaining migrations are replanned if the
+cluster drifted from what the plan expects.
+"""
+from .algorithm import shift_usage
+from .executor import BandwidthEstimate, MigrationLimits
+from .helper import get_logger
+from .inventory import map_concurrently
+from .model import Host, VM
+from .scheduler import schedule_migrations
+
+
+logger = get_logger(__name__)
+
+
+class Replanner:
+    """
+    Callback of :func:`pve_balance.executor.execute_migrations` replanning
+    the pending migrations. It keeps the state of the hosts the plan was made
+    for and updates it with the succeeded migrations and the current state of
+    the hosts involved in the remaining or failed migrations.
+
+    `plan` is called with the hosts and excluded hosts and returns the
+    migrations. Unless `refresh_memory` is false, the memory usage of the
+    hosts and VMs is refreshed, too. Otherwise, only VMs appearing or
+    disappearing change the memory usage. The memory usage is compared to
+    what the hosts were expected to use when the migrations were last
+    planned, so drift adding up over several refreshes triggers a replan,
+    too.
+    """
+    def __init__(self, proxmox, hosts, exclude, plan, limits=MigrationLimits(),
+                 estimate=None, concurrency=8, threshold=1024**3,
+                 refresh_memory=True):
+        self.proxmox = proxmox
+        self.hosts = {host.name: host for host in hosts}
+        self.exclude = {host.name for host in exclude}
+        self.plan = plan
+        self.limits = limits
+        self.estimate = estimate or BandwidthEstimate()
+        self.concurrency = concurrency
+        self.threshold = threshold
+        self.refresh_memory = refresh_memory
+        self.expected = {host.name: host.used_memory for host in hosts}
+
+    def move(self, migration):
+        """
+        Updates the state of the hosts for a succeeded migration
+        """
+        vm = migration.vm
+        source = self.hosts[vm.host]
+        target = self.hosts[migration.target_host]
+        source.vms = [other for other in source.vms if other.id != vm.id]
+        target.vms = list(target.vms) + [vm._replace(host=target.name)]
+        shift_usage(vm, source, target)
+        self.expected[source.name] -= vm.used_memory
+        self.expected[target.name] += vm.used_memory
+
+    def refresh(self, names):
+        """
+        Queries the current state of the named hosts and returns whether it
+        differs from the expected state by more than the threshold or by the
+        VMs running on them
+        """
+        def get_node(name):
+            node = self.proxmox.nodes(name)
+            return node.status.get(), node.qemu.get(full=1)
+
+        known = {
+            vm.id: (vm, host)
+            for host in self.hosts.values() for vm in host.vms
+        }
+        drifted = False
+        for name, result in map_concurrently(
+            get_node, sorted(names), self.concurrency
+        ):
+            if isinstance(result, Exception):
+                logger.warning("Could not refresh node {}: {}", name, result)
+                continue
+
+            status, node_vms = result
+            host = self.hosts[name]
+            vms = []
+            for data in node_vms:
+                if data["status"] != "running" or not data.get("mem"):
+                    continue
+
+                vm, owner = known.get(data["vmid"], (None, None))
+                if owner is not None and owner is not host:
+                    # Migrated by hand, so it's no longer on the other host,
+                    # unless that was refreshed already
+                    others = [other for other in owner.vms if other is not vm]
+                    if len(others) < len(owner.vms):
+                        owner.vms = others
+                        owner.used_memory -= vm.used_memory
+                        owner.used_cpu -= vm.cpu
+
+                if vm is None:
+                    vm = VM(
+                        id=data["vmid"],
+                        used_memory=data["mem"],
+                        total_memory=data["maxmem"],
+                        host=name,
+                        cpu=data.get("cpu", 0) * data.get("cpus", 0),
+                    )
+                elif self.refresh_memory:
+                    vm = vm._replace(
+                        used_memory=data["mem"],
+                        cpu=data.get("cpu", 0) * data.get("cpus", 0),
+                    )
+                vms.append(vm._replace(host=name))
+
+            if self.refresh_memory:
+                used_memory = status["memory"]["used"]
+                used_cpu = status.get("cpu", 0) * status.get(
+                    "cpuinfo", {},
+                ).get("cpus", 0)
+            else:
+                used_memory = host.used_memory + sum(
+                    vm.used_memory for vm in vms
+                ) - sum(vm.used_memory for vm in host.vms)
+                used_cpu = host.used_cpu + sum(vm.cpu for vm in vms) - sum(
+                    vm.cpu for vm in host.vms
+                )
+
+            if (
+                abs(used_memory - self.expected[name]) > self.threshold
+                or {vm.id for vm in vms} != {vm.id for vm in host.vms}
+            ):
+                logger.info(
+                    "Node {} drifted from the plan, using {!b} of memory "
+                    "instead of {!b}",
+                    name,
+                    used_memory,
+                    self.expected[name],
+                )
+                drifted = True
+
+            host.vms = vms
+            host.used_memory = used_memory
+            host.used_cpu = used_cpu
+
+        return drifted
+
+    def project(self, running):
+        """
+        Returns copies of the hosts as if the running migrations finished.
+        Their VMs are left out, so they aren't planned again.
+        """
+        hosts = {
+            name: Host(
+                name=host.name,
+                used_memory=host.used_memory,
+                total_memory=host.total_memory,
+                vms=list(host.vms),
+                used_cpu=host.used_cpu,
+                total_cpu=host.total_cpu,
+            )
+            for name, host in self.hosts.items()
+        }
+        for migration in running:
+            vm = migration.vm
+            source = hosts[vm.host]
+            target = hosts[migration.target_host]
+            source.vms = [other for other in source.vms if other.id != vm.id]
+            shift_usage(vm, source, target)
+
+        return list(hosts.values())
+
+    def __call__(self, finished, running, pending, failed=()):
+        # VMs of failed migrations stay where they are
+        for migration in finished:
+            self.move(migration)
+        finished = finished + list(failed)
+
+        # Hosts with running migrations are in flux, so rely on the expected
+        # state for them
+        busy = {migration.vm.host for migration in running}
+        busy.update(migration.target_host for migration in running)
+        involved = {migration.vm.host for migration in finished + pending}
+        involved.update(
+            migration.target_host for migration in finished + pending
+        )
+        if not self.refresh(involved - busy):
+            return pending
+        self.expected = {
+            name: host.used_memory for name, host in self.hosts.items()
+        }
+
+        hosts = self.project(running)
+        migrations = self.plan(
+            hosts, [host for host in hosts if host.name in self.exclude],
+        )
+        migrations, _ = schedule_migrations(
+            migrations, self.limits, self.estimate,
+        )
+
+        before = {(m.vm.id, m.target_host) for m in pending}
+        after = {(m.vm.id, m.target_host) for m in migrations}
+        for migration in pending:
+            if (migration.vm.id, migration.target_host) not in after:
+                logger.info(
+                    "Dropping migration of VM {0.vm.id} to host "
+                    "{0.target_host}, which is no longer useful",
+                    migration,
+                )
+        logger.info(
+            "Replanned {} remaining migrations, {} of them new",
+            len(migrations),
+            len(after - before),
+        )
+
+        return migrations
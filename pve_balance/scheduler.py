@@ -0,0 +1,68 @@
+from heapq import heappop, heappush
+from operator import itemgetter
+
+from .cost import migration_bytes
+from .executor import BandwidthEstimate, MigrationLimits, MigrationSlots
+from .helper import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def schedule_migrations(migrations, limits=MigrationLimits(), estimate=None):
+    """
+    Orders the migrations to finish all of them as early as possible and
+    returns them along with the predicted total duration in seconds.
+
+    The executor starts the first migration of the list that isn't blocked
+    by the limits, so this is list scheduling. Starting the longest
+    migrations first avoids a long migration being started last, leaving
+    all other hosts idle in the meantime.
+    """
+    if estimate is None:
+        estimate = BandwidthEstimate()
+
+    pending = sorted(
+        (
+            (migration, estimate.duration(migration))
+            for migration in migrations
+        ),
+        key=itemgetter(1),
+        reverse=True,
+    )
+
+    # Simulate the executor to predict the total duration
+    order = []
+    slots = MigrationSlots(limits)
+    finishing = []
+    now = 0
+    while pending:
+        postponed = []
+        for migration, duration in pending:
+            if slots.blocking_reason(migration):
+                postponed.append((migration, duration))
+                continue
+
+            slots.acquire(migration)
+            heappush(finishing, (now + duration, len(order), migration))
+            order.append(migration)
+
+        pending = postponed
+        if pending:
+            now, _, migration = heappop(finishing)
+            slots.release(migration)
+
+    makespan = max((end for end, _, _ in finishing), default=now)
+
+    return order, makespan
+
+
+def log_schedule(migrations, makespan):
+    logger.info(
+        "Planned {} migrations of VMs using {!b} of memory, transferring an "
+        "estimated {!b} in {:.0f}s",
+        len(migrations),
+        sum(migration.vm.used_memory for migration in migrations),
+        sum(migration_bytes(migration.vm) for migration in migrations),
+        makespan,
+    )
@@ -0,0 +1,96 @@
+"""
+Recording the inventory of a cluster to plan migrations for it offline.
+
+A snapshot is a JSON Lines file, compressed with gzip if its name ends with
+``.gz``. The first line is a header with the format version and the names of
+the excluded hosts. Each host follows as an object, then its VMs as arrays,
+one per line, so snapshots can be read as a stream.
+"""
+import gzip
+import json
+
+from .model import Host, VMTable
+
+
+SNAPSHOT_FORMAT = "pve-balance-snapshot"
+SNAPSHOT_VERSION = 1
+
+# Fields of the VM arrays, besides the host given by the preceding line
+VM_FIELDS = ("id", "used_memory", "total_memory", "cpu", "local_disk")
+
+
+def open_snapshot(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def write_snapshot(path, hosts, exclude=[]):
+    """
+    Writes the hosts, their VMs and the excluded hosts to a snapshot file
+    """
+    def write(line):
+        f.write(json.dumps(line, separators=(",", ":")))
+        f.write("\n")
+
+    with open_snapshot(path, "w") as f:
+        write({
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "exclude": [host.name for host in exclude],
+        })
+        for host in hosts:
+            write({
+                "host": host.name,
+                "used_memory": host.used_memory,
+                "total_memory": host.total_memory,
+                "used_cpu": host.used_cpu,
+                "total_cpu": host.total_cpu,
+            })
+            for vm in host.vms:
+                write([getattr(vm, field) for field in VM_FIELDS])
+
+
+def read_snapshot(path):
+    """
+    Reads a snapshot file line by line and returns the hosts and the
+    excluded hosts. The VMs are stored in a :class:`pve_balance.model.
+    VMTable`, to keep large inventories compact.
+    """
+    table = VMTable()
+    with open_snapshot(path, "r") as f:
+        try:
+            header = json.loads(next(f))
+        except (StopIteration, ValueError):
+            header = {}
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError("{} is not a snapshot".format(path))
+        if header["version"] != SNAPSHOT_VERSION:
+            raise ValueError(
+                "Unsupported snapshot version {}".format(header["version"])
+            )
+
+        hosts = []
+        for number, line in enumerate(f, 2):
+            record = json.loads(line)
+            if isinstance(record, dict):
+                hosts.append(Host(
+                    name=record["host"],
+                    used_memory=record["used_memory"],
+                    total_memory=record["total_memory"],
+                    vms=[],
+                    used_cpu=record["used_cpu"],
+                    total_cpu=record["total_cpu"],
+                ))
+            elif hosts:
+                hosts[-1].vms.append(table.append(
+                    host=hosts[-1].name,
+                    **dict(zip(VM_FIELDS, record))
+                ))
+            else:
+                raise ValueError(
+                    "VM without host in line {} of {}".format(number, path)
+                )
+
+    by_name = {host.name: host for host in hosts}
+    return hosts, [by_name[name] for name in header["exclude"]]
@@ -0,0 +1,211 @@
+"""
+Planning variants of a plan side by side to pick one.
+
+Which threshold, engine or hosts to drain give a good enough plan at the
+least cost is a matter of trying. A sweep plans every combination of them
+for a single inventory in worker processes and reports the remaining
+imbalance, the number of migrations, the bytes to transfer and the predicted
+duration of each plan.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import logging
+
+from . import calculate, connect
+from .algorithm import measure_imbalance, shift_usage
+from .cost import migration_bytes
+from .executor import DEFAULT_BANDWIDTH, BandwidthEstimate, MigrationLimits
+from .helper import formatter
+from .history import add_memory_history
+from .inventory import add_local_disks, get_inventory
+from .model import Host
+from .scheduler import schedule_migrations
+from .snapshot import read_snapshot
+
+
+# A variant to plan: the threshold in bytes, the engine and the names of the
+# hosts to drain on top of the excluded ones
+Variant = namedtuple("Variant", ("threshold", "engine", "drain"))
+
+# Inventory and options of the worker process, set by init_worker
+worker_state = {}
+
+
+def make_variants(thresholds, engines, drain_sets=[()]):
+    """
+    Returns the variants of all combinations of thresholds, engines and sets
+    of hosts to drain
+    """
+    return [
+        Variant(threshold, engine, tuple(drain))
+        for threshold, engine, drain in product(
+            thresholds, engines, drain_sets,
+        )
+    ]
+
+
+def remaining_imbalance(hosts, exclude, migrations, cpu_weight=0):
+    """
+    Returns the largest memory or CPU imbalance of the hosts left after the
+    migrations
+    """
+    projected = {
+        host.name: Host(
+            name=host.name,
+            used_memory=host.used_memory,
+            total_memory=host.total_memory,
+            vms=[],
+            used_cpu=host.used_cpu,
+            total_cpu=host.total_cpu,
+        )
+        for host in hosts
+    }
+    for migration in migrations:
+        vm = migration.vm
+        source = projected[vm.host]
+        target = projected[migration.target_host]
+        shift_usage(vm, source, target)
+
+    return measure_imbalance(
+        list(projected.values()),
+        [projected[host.name] for host in exclude],
+        cpu_weight,
+    )
+
+
+def init_worker(hosts, exclude_names, options):
+    # The planners log every migration, which would garble the output of
+    # concurrent workers
+    logging.disable(logging.INFO)
+    worker_state.update(
+        hosts=hosts, exclude_names=exclude_names, options=options,
+    )
+
+
+def plan_variant(variant):
+    """
+    Plans a variant for the inventory of the worker process and returns a
+    dict of the results
+    """
+    hosts = worker_state["hosts"]
+    options = worker_state["options"]
+    exclude_names = set(worker_state["exclude_names"]).union(variant.drain)
+    exclude = [host for host in hosts if host.name in exclude_names]
+
+    migrations = calculate(
+        hosts,
+        exclude,
+        variant.engine,
+        options["cost"],
+        options["cpu_weight"],
+        options["time_budget"],
+        threshold=variant.threshold,
+        compact_tolerance=options["compact_tolerance"],
+    )
+    migrations, duration = schedule_migrations(
+        migrations, options["limits"], options["estimate"],
+    )
+
+    return {
+        "threshold": variant.threshold,
+        "engine": variant.engine,
+        "drain": list(variant.drain),
+        "migrations": len(migrations),
+        "bytes": sum(
+            migration_bytes(migration.vm) for migration in migrations
+        ),
+        "duration": duration,
+        "remaining_imbalance": remaining_imbalance(
+            hosts, exclude, migrations, options["cpu_weight"],
+        ),
+    }
+
+
+def sweep_variants(hosts, exclude, variants, cost=None, cpu_weight=0,
+                   limits=MigrationLimits(), estimate=None, time_budget=0,
+                   workers=None, compact_tolerance=0):
+    """
+    Plans the variants for the hosts in up to `workers` processes, by
+    default one per CPU, and returns their results in the order of the
+    variants. The inventory is sent to each worker once.
+    """
+    options = {
+        "cost": cost,
+        "cpu_weight": cpu_weight,
+        "limits": limits,
+        "estimate": estimate or BandwidthEstimate(),
+        "time_budget": time_budget,
+        "compact_tolerance": compact_tolerance,
+    }
+    with ProcessPoolExecutor(
+        workers,
+        initializer=init_worker,
+        initargs=(hosts, [host.name for host in exclude], options),
+    ) as executor:
+        return list(executor.map(plan_variant, variants))
+
+
+def sweep(pve_config=None, snapshot=None, exclude_names=[],
+          thresholds=[1024**3], engines=["reference"], drain_sets=[()],
+          workers=None, inventory="resources", concurrency=8, timeout=None,
+          limits=MigrationLimits(), bandwidth=DEFAULT_BANDWIDTH,
+          minimize="migrations", cpu_weight=0, memory="current",
+          window=24 * 3600, rrd_cache=None, time_budget=0,
+          compact_tolerance=0):
+    """
+    Plans the variants of all combinations of thresholds, engines and sets of
+    hosts to drain for the cluster, or the recorded `snapshot` of one, and
+    returns their results. No migrations are executed.
+    """
+    if snapshot is not None:
+        hosts, exclude = read_snapshot(snapshot)
+    else:
+        proxmox = connect(pve_config, timeout)
+        hosts = get_inventory(proxmox, inventory, concurrency)
+        add_memory_history(
+            proxmox, hosts, memory, window, rrd_cache, concurrency,
+        )
+        if minimize == "bytes":
+            add_local_disks(proxmox, hosts, concurrency)
+        exclude = []
+    exclude.extend(
+        host for host in hosts
+        if host.name in exclude_names and host not in exclude
+    )
+
+    variants = make_variants(thresholds, engines, drain_sets)
+    return sweep_variants(
+        hosts,
+        exclude,
+        variants,
+        migration_bytes if minimize == "bytes" else None,
+        cpu_weight,
+        limits,
+        BandwidthEstimate(bandwidth),
+        time_budget,
+        workers,
+        compact_tolerance,
+    )
+
+
+def format_results(results):
+    """
+    Returns the results of a sweep as a table
+    """
+    lines = [
+        "threshold    engine drain                 migr.      bytes "
+        "duration  remaining"
+    ]
+    for result in results:
+        lines.append(formatter.format(
+            "{!b:>9} {:>9} {:<20} {:>6} {!b:>10} {:>7.0f}s {!b:>10}",
+            result["threshold"],
+            result["engine"],
+            ",".join(result["drain"]) or "-",
+            result["migrations"],
+            result["bytes"],
+            result["duration"],
+            result["remaining_imbalance"],
+        ))
+    return "\n".join(lines)
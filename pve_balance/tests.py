@@ -1,10 +1,95 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import json
+import pickle
+from shutil import which
+from tempfile import TemporaryDirectory
+from threading import Event
+import os
 import unittest
 
-from .model import Host, VM, Migration
-from .algorithm import calculate_migrations
+from proxmoxer.core import ResourceException
+from requests import RequestException
+
+from .model import Host, VM, VMTable, Migration, SortedVMs, update_vm
+from .algorithm import calculate_migrations, measure_imbalance
+from .benchmark import generate_cluster, run, run_snapshot
+from .executor import (
+    BandwidthEstimate,
+    MigrationLimits,
+    MigrationSlots,
+    execute_migrations,
+    wait_for_tasks,
+)
+from .scheduler import schedule_migrations
+from .cost import migration_bytes
+from . import balance, calculate
+from .fakeapi import ApiError, FakeCluster, FakeProxmox, FakeServer
+from .metrics import Metrics
+from .helper import ByteFormatter, Trace
+from .history import add_memory_history, summarize, timeframe
+from .compact import compact_migrations
+from .drain import calculate_migrations as calculate_drain
+from .localsearch import improve_migrations, load
+from .plancache import PlanCache, fingerprint
+from .replan import Replanner
+from .snapshot import read_snapshot, write_snapshot
+from .sweep import (
+    format_results,
+    make_variants,
+    remaining_imbalance,
+    sweep_variants,
+)
+from .inventory import (
+    get_inventory,
+    inventory_from_nodes,
+    inventory_from_resources,
+    local_disk_size,
+)
+
+try:
+    from .vectorized import calculate_migrations as calculate_vectorized
+except ImportError:
+    calculate_vectorized = None
+
+
+def as_vms(vms):
+    """
+    Returns the VMs as VM tuples, as views only equal themselves
+    """
+    return [VM(*vm) for vm in vms]
+
+
+def as_migrations(migrations):
+    return [
+        Migration(VM(*migration.vm), migration.target_host)
+        for migration in migrations
+    ]
+
+
+def fake_api(responses, requests=None):
+    """
+    Returns a fake API client answering requests with the `responses` by
+    path. Callable responses are called with the request's parameters and
+    exceptions are raised. Requested paths are appended to `requests`.
+    """
+    def handle(method, path, params):
+        if requests is not None:
+            requests.append(path)
+        response = responses[path]
+        if callable(response):
+            response = response(**params)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    return FakeProxmox(handle)
 
 
 class TestCase1(unittest.TestCase):
+    calculate_migrations = staticmethod(calculate_migrations)
+
     vm_sets = (
         (
             VM(1, 1024 ** 3, 1024 ** 3, ""),
@@ -19,7 +104,7 @@ class TestCase1(unittest.TestCase):
     )
 
     def test_empty(self):
-        self.assertEqual(calculate_migrations([]), [])
+        self.assertEqual(self.calculate_migrations([]), [])
 
     def test_single_empty_host(self):
         hosts = [Host(
@@ -28,7 +113,7 @@ class TestCase1(unittest.TestCase):
             total_memory=10 * 1024 ** 3,
             vms=[],
         )]
-        self.assertEqual(calculate_migrations(hosts), [])
+        self.assertEqual(self.calculate_migrations(hosts), [])
 
     def test_single_host(self):
         hosts = [Host(
@@ -37,7 +122,7 @@ class TestCase1(unittest.TestCase):
             total_memory=10 * 1024 ** 3,
             vms=self.vm_sets[0],
         )]
-        self.assertEqual(calculate_migrations(hosts), [])
+        self.assertEqual(self.calculate_migrations(hosts), [])
 
     def test_totally_imbalanced(self):
         hosts = [
@@ -55,10 +140,40 @@ class TestCase1(unittest.TestCase):
             ),
         ]
         self.assertEqual(
-            calculate_migrations(hosts),
+            self.calculate_migrations(hosts),
             [Migration(self.vm_sets[0][0], hosts[1].name)]
         )
 
+    def test_ties(self):
+        GiB = 1024 ** 3
+
+        def hosts(*vm_sets):
+            return [
+                Host(name, sum(memory for memory in vm_set) * GiB, 16 * GiB, [
+                    VM(10 * i + j, memory * GiB, 4 * GiB, name)
+                    for j, memory in enumerate(vm_set, 1)
+                ])
+                for i, (name, vm_set) in enumerate(zip("abcd", vm_sets))
+            ]
+
+        # Hosts of equal imbalance are tried like in a list sorted by
+        # descending imbalance, the last donor first
+        cluster = hosts((), (1, 1), (1, 1))
+        self.assertEqual(
+            as_migrations(self.calculate_migrations(cluster)),
+            [Migration(cluster[2].vms[0], "a")],
+        )
+        # After a migration, the list is sorted again, moving a donor whose
+        # imbalance increased after the hosts it ties with
+        cluster = hosts((), (2, 2, 1), (), (1, 2))
+        self.assertEqual(
+            as_migrations(self.calculate_migrations(cluster)),
+            [
+                Migration(cluster[1].vms[0], "a"),
+                Migration(cluster[1].vms[2], "c"),
+            ],
+        )
+
     def test_little_imbalanced(self):
         hosts = [
             Host(
@@ -75,7 +190,7 @@ class TestCase1(unittest.TestCase):
             ),
         ]
         self.assertEqual(
-            calculate_migrations(hosts),
+            self.calculate_migrations(hosts),
             []
         )
 
@@ -101,13 +216,218 @@ class TestCase1(unittest.TestCase):
             ),
         ]
         self.assertEqual(
-            calculate_migrations(hosts, exclude=[hosts[1]]),
+            self.calculate_migrations(hosts, exclude=[hosts[1]]),
             [
                 Migration(self.vm_sets[1][0], hosts[2].name),
                 Migration(self.vm_sets[2][0], hosts[0].name),
             ]
         )
 
+    def test_cpu_weight(self):
+        vms = (
+            VM(1, 1024 ** 3, 1024 ** 3, "host1", cpu=1),
+            VM(2, 3 * 1024 ** 3, 3 * 1024 ** 3, "host1", cpu=1),
+        )
+        hosts = [
+            Host(
+                name="host1",
+                used_memory=4 * 1024 ** 3,
+                total_memory=10 * 1024 ** 3,
+                vms=vms,
+                used_cpu=2,
+                total_cpu=8,
+            ),
+            Host(
+                name="host2",
+                used_memory=4 * 1024 ** 3,
+                total_memory=10 * 1024 ** 3,
+                vms=[VM(3, 4 * 1024 ** 3, 4 * 1024 ** 3, "host2")],
+                used_cpu=0,
+                total_cpu=8,
+            ),
+        ]
+        self.assertEqual(self.calculate_migrations(hosts), [])
+        # Memory is balanced, but all CPU load is on host1. Trade a little
+        # memory imbalance for CPU balance.
+        self.assertEqual(
+            self.calculate_migrations(hosts, cpu_weight=1),
+            [Migration(vms[0], "host2")],
+        )
+        self.assertEqual(hosts[0].cpu_imbalance, 0)
+        self.assertEqual(measure_imbalance(hosts), 0)
+        self.assertEqual(
+            measure_imbalance(hosts, cpu_weight=1),
+            1.25 * 1024 ** 3,
+        )
+
+    def test_cpu_same_side(self):
+        hosts = [
+            Host(
+                name=f"host{i}",
+                used_memory=1024 ** 3,
+                total_memory=10 * 1024 ** 3,
+                vms=[VM(i, 1024 ** 3, 1024 ** 3, f"host{i}", cpu=4)],
+                used_cpu=4,
+                total_cpu=8,
+            )
+            for i in (1, 2)
+        ]
+        hosts.append(
+            Host(
+                name="host3",
+                used_memory=10 * 1024 ** 3,
+                total_memory=10 * 1024 ** 3,
+                vms=[VM(3, 10 * 1024 ** 3, 10 * 1024 ** 3, "host3")],
+                used_cpu=0,
+                total_cpu=8,
+            )
+        )
+        trace = Trace()
+        self.calculate_migrations(hosts, cpu_weight=1, trace=trace)
+        # host1 and host2 are under-loaded in memory and over-loaded in CPU
+        # alike, so migrating between them can't improve the balance
+        pairs = {
+            line for line in str(trace).splitlines()
+            if line.startswith("Trying")
+        }
+        self.assertEqual(
+            pairs,
+            {
+                "Trying migrating from host host1 to host host3",
+                "Trying migrating from host host2 to host host3",
+                "Trying migrating from host host3 to host host1",
+                "Trying migrating from host host3 to host host2",
+            },
+        )
+
+    def test_trace(self):
+        hosts = [
+            Host(
+                name="host1",
+                used_memory=sum(vm.used_memory for vm in self.vm_sets[0]),
+                total_memory=10 * 1024 ** 3,
+                vms=self.vm_sets[0],
+            ),
+            Host(
+                name="host2",
+                used_memory=0,
+                total_memory=10 * 1024 ** 3,
+                vms=[],
+            ),
+        ]
+        trace = Trace()
+        self.calculate_migrations(hosts, trace=trace)
+        self.assertEqual(
+            str(trace).splitlines(),
+            [
+                "Remaining imbalance: 1.50 GB",
+                "Trying migrating from host host1 to host host2",
+                "Planning migration of VM 1 to host host2",
+            ],
+        )
+
+
+class TestSortedVMs(unittest.TestCase):
+    vms = (
+        VM(1, 4, 4, ""),
+        VM(2, 1, 1, ""),
+        VM(3, 3, 3, ""),
+        VM(4, 1, 1, ""),
+        VM(5, 5, 5, ""),
+    )
+
+    def test_closest(self):
+        vms = SortedVMs(self.vms)
+        self.assertEqual(
+            [vm.id for vm in vms.closest(3)],
+            [3, 1, 2, 4, 5],
+        )
+        self.assertEqual(
+            [vm.id for vm in vms.closest(2)],
+            [2, 4, 3, 1, 5],
+        )
+
+    def test_closest_limit(self):
+        vms = SortedVMs(self.vms)
+        self.assertEqual([vm.id for vm in vms.closest(5, limit=3)], [3, 2, 4])
+        self.assertEqual([vm.id for vm in vms.closest(1, limit=0)], [])
+
+    def test_remove(self):
+        vms = SortedVMs(self.vms)
+        vms.remove(self.vms[3])
+        vms.remove(self.vms[0])
+        self.assertEqual([vm.id for vm in vms], [2, 3, 5])
+
+
+class TestVMTable(unittest.TestCase):
+    def setUp(self):
+        self.table = VMTable()
+        self.views = [
+            self.table.append(1, 1024, 2048, "host1"),
+            self.table.append(2, 512, 1024, "host2", cpu=0.5, local_disk=64),
+            self.table.append(3, 256, 512, "host1"),
+        ]
+        self.vms = [
+            VM(1, 1024, 2048, "host1"),
+            VM(2, 512, 1024, "host2", cpu=0.5, local_disk=64),
+            VM(3, 256, 512, "host1"),
+        ]
+
+    def test_view(self):
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table.host_names, ["host1", "host2"])
+        self.assertEqual(list(self.table), self.views)
+        view = self.views[1]
+        self.assertEqual(
+            (view.id, view.used_memory, view.total_memory, view.host,
+             view.cpu, view.local_disk),
+            (2, 512, 1024, "host2", 0.5, 64),
+        )
+        self.assertEqual(view._asdict(), self.vms[1]._asdict())
+        self.assertEqual(repr(view), repr(self.vms[1]))
+        with self.assertRaises(AttributeError):
+            view.used_memory = 0
+
+    def test_equality(self):
+        self.assertEqual(as_vms(self.views), self.vms)
+        self.assertEqual(set(self.views), set(self.table))
+        self.assertNotEqual(self.views[0], self.views[2])
+        # Views are identified by their table and index
+        self.assertNotEqual(
+            self.views[0], VMTable().append(1, 1024, 2048, "host1"),
+        )
+        # Views can change, so they never equal a VM with the same fields
+        self.assertNotEqual(self.views[0], self.vms[0])
+        self.assertNotEqual(self.vms[0], self.views[0])
+
+    def test_replace(self):
+        vm = self.views[0]._replace(host="host2")
+        self.assertIsInstance(vm, VM)
+        self.assertEqual(vm, self.vms[0]._replace(host="host2"))
+        self.assertEqual(self.views[0].host, "host1")
+
+    def test_update(self):
+        view = self.views[0]
+        self.assertIs(update_vm(view, used_memory=512, host="host3"), view)
+        self.assertEqual(
+            VM(*view), self.vms[0]._replace(used_memory=512, host="host3"),
+        )
+        self.assertEqual(self.table.host_names, ["host1", "host2", "host3"])
+        self.assertIn(view, set(self.views))
+        self.assertEqual(
+            update_vm(self.vms[0], local_disk=1),
+            self.vms[0]._replace(local_disk=1),
+        )
+
+    def test_copy(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.views)), self.vms)
+        self.assertEqual(deepcopy(self.views), self.vms)
+
+    def test_slots(self):
+        host = Host("host1", 0, 0, self.views)
+        with self.assertRaises(AttributeError):
+            host.spare = True
+
 
 class TestCase2(unittest.TestCase):
     """Real-life test data"""
@@ -519,12 +839,898 @@ class TestCase2(unittest.TestCase):
                 if host.name == migration.target_host
             )
             target_host.vms.append(
-                VM(*migration.vm[:-1], host=migration.target_host)
+                migration.vm._replace(host=migration.target_host)
             )
             target_host.used_memory += migration.vm.used_memory
         calculate_migrations(hosts)
         self.assertEqual(calculate_migrations(hosts), [])
 
 
+@unittest.skipIf(calculate_vectorized is None, "NumPy is not installed")
+class TestVectorized(TestCase1):
+    calculate_migrations = staticmethod(calculate_vectorized)
+
+    def test_same_migrations(self):
+        hosts = deepcopy(TestCase2.hosts)
+        self.assertEqual(
+            calculate_vectorized(hosts, exclude=hosts[:2]),
+            calculate_migrations(hosts, exclude=hosts[:2]),
+        )
+        self.assertEqual(
+            calculate_vectorized(hosts),
+            calculate_migrations(hosts),
+        )
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_cluster(self):
+        hosts, exclude = generate_cluster(10, 100, "heavy-tailed", skew=1,
+                                          num_excluded=2, seed=42)
+        self.assertEqual(len(hosts), 10)
+        self.assertEqual(len(exclude), 2)
+        self.assertEqual(sum(len(host.vms) for host in hosts), 100)
+        for host in hosts:
+            self.assertLessEqual(host.used_memory, host.total_memory)
+            for vm in host.vms:
+                self.assertEqual(vm.host, host.name)
+
+        other_hosts, _ = generate_cluster(10, 100, "heavy-tailed", skew=1,
+                                          num_excluded=2, seed=42)
+        self.assertEqual(
+            [host.vms for host in hosts],
+            [host.vms for host in other_hosts],
+        )
+
+    def test_columnar(self):
+        hosts, exclude = generate_cluster(8, 200, skew=1, num_excluded=1)
+        columnar_hosts, columnar_exclude = generate_cluster(
+            8, 200, skew=1, num_excluded=1, model="columnar",
+        )
+        self.assertEqual(
+            [host.vms for host in hosts],
+            [as_vms(host.vms) for host in columnar_hosts],
+        )
+        migrations = calculate_migrations(hosts, exclude)
+        self.assertEqual(
+            as_migrations(
+                calculate_migrations(columnar_hosts, columnar_exclude),
+            ),
+            migrations,
+        )
+        if calculate_vectorized is not None:
+            self.assertEqual(
+                as_migrations(calculate_vectorized(*generate_cluster(
+                    8, 200, skew=1, num_excluded=1, model="columnar",
+                ))),
+                migrations,
+            )
+
+    def test_run(self):
+        result = run("reference", 4, 50, repeat=1)
+        self.assertGreaterEqual(result["iterations"], result["migrations"])
+        self.assertGreater(result["bytes"], 0)
+        self.assertLessEqual(result["remaining_imbalance"], 1024 ** 3)
+
+
+class TestInventory(unittest.TestCase):
+    resources = [
+        {"type": "node", "node": "b", "status": "online",
+         "mem": 6, "maxmem": 16, "cpu": 0.25, "maxcpu": 8},
+        {"type": "node", "node": "a", "status": "online",
+         "mem": 2, "maxmem": 16},
+        {"type": "node", "node": "c", "status": "offline"},
+        {"type": "storage", "node": "a", "storage": "local"},
+        {"type": "qemu", "node": "b", "vmid": 100, "status": "running",
+         "mem": 4, "maxmem": 8},
+        {"type": "qemu", "node": "b", "vmid": 101, "status": "stopped",
+         "mem": 0, "maxmem": 8},
+        {"type": "lxc", "node": "a", "vmid": 102, "status": "running",
+         "mem": 1, "maxmem": 2},
+    ]
+
+    def test_inventory_from_resources(self):
+        proxmox = fake_api({"cluster/resources": self.resources})
+        hosts = inventory_from_resources(proxmox)
+        self.assertEqual([host.name for host in hosts], ["a", "b"])
+        self.assertEqual(hosts[0].vms, [])
+        self.assertEqual(hosts[1].used_memory, 6)
+        self.assertEqual(hosts[1].total_memory, 16)
+        self.assertEqual(as_vms(hosts[1].vms), [VM(100, 4, 8, "b")])
+        self.assertEqual(hosts[1].used_cpu, 2)
+        self.assertEqual(hosts[1].total_cpu, 8)
+
+    def test_inventory_from_nodes(self):
+        # Offline nodes report no memory and fail to list their VMs
+        responses = {
+            "nodes": [
+                {"node": "a", "status": "online", "mem": 2, "maxmem": 16},
+                {"node": "b", "status": "online", "mem": 6, "maxmem": 16},
+                {"node": "c", "status": "offline"},
+            ],
+            "nodes/a/qemu": [],
+            "nodes/b/qemu": [
+                {"vmid": 100, "status": "running", "mem": 4, "maxmem": 8},
+            ],
+            "nodes/c/qemu": ApiError(500, "timeout"),
+        }
+        with self.assertLogs("pve_balance.inventory", "WARNING") as logs:
+            hosts = inventory_from_nodes(fake_api(responses), 2)
+        self.assertIn("Ignoring node c with status offline", logs.output[0])
+        self.assertEqual([host.name for host in hosts], ["a", "b"])
+        self.assertEqual(as_vms(hosts[1].vms), [VM(100, 4, 8, "b")])
+
+        # Planning without a node would balance towards a wrong average
+        responses["nodes/a/qemu"] = ApiError(500, "timeout")
+        with self.assertRaises(ResourceException):
+            inventory_from_nodes(fake_api(responses), 2)
+
+    def test_get_inventory_fallback(self):
+        proxmox = fake_api({
+            "cluster/resources": RequestException("Read timed out"),
+            "nodes": [
+                {"node": "a", "status": "online", "mem": 2, "maxmem": 16},
+            ],
+            "nodes/a/qemu": [],
+        })
+        hosts = get_inventory(proxmox)
+        self.assertEqual([host.name for host in hosts], ["a"])
+
+
+class TestExecutor(unittest.TestCase):
+    def migration(self, source, target):
+        return Migration(VM(1, 1, 1, source), target)
+
+    def slots(self, running, limits=MigrationLimits()):
+        slots = MigrationSlots(limits)
+        for migration in running:
+            slots.acquire(migration)
+        return slots
+
+    def test_default_limits(self):
+        slots = self.slots([self.migration("a", "b")])
+        self.assertIsNone(slots.blocking_reason(self.migration("c", "d")))
+        for source, target in (("a", "c"), ("c", "a"), ("b", "c")):
+            self.assertIsNotNone(
+                slots.blocking_reason(self.migration(source, target))
+            )
+
+        slots.release(self.migration("a", "b"))
+        self.assertIsNone(slots.blocking_reason(self.migration("a", "c")))
+
+    def test_limits(self):
+        running = [self.migration("a", "b"), self.migration("a", "c")]
+        limits = MigrationLimits(
+            outgoing=2, incoming=2, per_host=3, total=None,
+        )
+        slots = self.slots(running, limits)
+        self.assertIsNone(slots.blocking_reason(self.migration("b", "c")))
+        self.assertIsNone(slots.blocking_reason(self.migration("d", "a")))
+        self.assertIsNotNone(slots.blocking_reason(self.migration("a", "d")))
+
+        slots = self.slots(running, limits._replace(total=2))
+        self.assertIsNotNone(slots.blocking_reason(self.migration("d", "e")))
+
+    def test_wait_for_tasks(self):
+        statuses = {
+            "UPID:a:1": {"status": "stopped", "exitstatus": "OK"},
+            "UPID:b:2": {"status": "running"},
+            "UPID:c:3": {"status": "stopped", "exitstatus": "aborted"},
+            "UPID:e:4": None,
+        }
+        responses = {
+            "nodes/{}/tasks/{}/status".format(upid.split(":")[1], upid):
+                status or RequestException("Read timed out")
+            for upid, status in statuses.items()
+        }
+        queried = []
+
+        running = {
+            upid: self.migration(upid.split(":")[1], "d")
+            for upid in statuses
+        }
+        started = dict.fromkeys(running, 0)
+        estimate = BandwidthEstimate()
+        metrics = Metrics()
+        succeeded, failed = wait_for_tasks(
+            fake_api(responses, queried), running, started, estimate,
+            metrics,
+        )
+        self.assertEqual(succeeded, [self.migration("a", "d")])
+        self.assertEqual(failed, [self.migration("c", "d")])
+        # Tasks whose status is unknown are still running
+        self.assertEqual(list(running), ["UPID:b:2", "UPID:e:4"])
+        self.assertEqual(list(started), ["UPID:b:2", "UPID:e:4"])
+        self.assertEqual(queried, list(responses))
+        self.assertEqual(
+            [migration["vm"] for migration in metrics.migrations],
+            [succeeded[0].vm.id],
+        )
+        self.assertEqual(
+            [migration["source"] for migration in metrics.failed_migrations],
+            ["c"],
+        )
+
+    def test_stop(self):
+        stop = Event()
+        posted = []
+
+        def migrate(target, **params):
+            # Receive SIGTERM while the first migration is running
+            posted.append(target)
+            stop.set()
+            return "UPID:a:{}".format(len(posted))
+
+        proxmox = fake_api({
+            "nodes/a/qemu/1/migrate": migrate,
+            "nodes/a/tasks/UPID:a:1/status": {
+                "status": "stopped", "exitstatus": "OK",
+            },
+        })
+        execute_migrations(
+            proxmox,
+            [self.migration("a", "b"), self.migration("a", "c")],
+            stop=stop,
+        )
+        self.assertEqual(posted, ["b"])
+
+    def test_bandwidth_estimate(self):
+        estimate = BandwidthEstimate(bandwidth=100, weight=0.5)
+        migration = Migration(VM(1, 1000, 1000, "a"), "b")
+        self.assertEqual(estimate.duration(migration), 10)
+        estimate.observe(migration, 5)
+        self.assertEqual(estimate.bandwidth, 150)
+
+
+class TestCost(unittest.TestCase):
+    def test_migration_bytes(self):
+        self.assertEqual(migration_bytes(VM(1, 100, 200, "a")), 100)
+        self.assertEqual(
+            migration_bytes(VM(1, 100, 200, "a", cpu=2, local_disk=1000)),
+            1120,
+        )
+
+    def test_local_disk_size(self):
+        config = {
+            "scsi0": "local-lvm:vm-100-disk-0,size=32G",
+            "scsi1": "ceph:vm-100-disk-1,size=100G",
+            "ide2": "local:iso/debian.iso,media=cdrom,size=600M",
+            "efidisk0": "local-lvm:vm-100-disk-2,size=512K",
+            "net0": "virtio=AA:BB:CC:DD:EE:FF,bridge=vmbr0",
+        }
+        self.assertEqual(
+            local_disk_size(config, {"local", "local-lvm"}),
+            32 * 1024 ** 3 + 512 * 1024,
+        )
+
+    def test_minimize_bytes(self):
+        vms = [
+            VM(1, 4 * 1024 ** 3, 4 * 1024 ** 3, "host1",
+               local_disk=100 * 1024 ** 3),
+            VM(2, 4 * 1024 ** 3, 4 * 1024 ** 3, "host1"),
+        ]
+        engines = [calculate_migrations]
+        if calculate_vectorized is not None:
+            engines.append(calculate_vectorized)
+
+        for engine in engines:
+            hosts = [
+                Host("host1", 8 * 1024 ** 3, 10 * 1024 ** 3, vms),
+                Host("host2", 0, 10 * 1024 ** 3, []),
+            ]
+            self.assertEqual(
+                engine(hosts),
+                [Migration(vms[0], "host2")],
+            )
+            self.assertEqual(
+                engine(hosts, cost=migration_bytes),
+                [Migration(vms[1], "host2")],
+            )
+
+
+class TestScheduler(unittest.TestCase):
+    def test_longest_first(self):
+        migrations = [
+            Migration(VM(3, 1, 1, "a"), "d"),
+            Migration(VM(2, 5, 5, "c"), "d"),
+            Migration(VM(4, 1, 1, "e"), "f"),
+            Migration(VM(1, 10, 10, "a"), "b"),
+        ]
+        order, makespan = schedule_migrations(
+            migrations, estimate=BandwidthEstimate(bandwidth=1),
+        )
+        self.assertEqual([m.vm.id for m in order], [1, 2, 4, 3])
+        self.assertEqual(makespan, 11)
+
+        order, makespan = schedule_migrations(
+            migrations,
+            limits=MigrationLimits(None, None, None, None),
+            estimate=BandwidthEstimate(bandwidth=1),
+        )
+        self.assertEqual(makespan, 10)
+
+    def test_empty(self):
+        self.assertEqual(schedule_migrations([]), ([], 0))
+
+
 if __name__ == "__main__":
     unittest.main()
+
+
+class TestHistory(unittest.TestCase):
+    def test_summarize(self):
+        samples = [[0, 60, 4], [60, 60, 2], [120, 1800, 1]]
+        self.assertEqual(summarize(samples, "average"), 2160 / 1920)
+        self.assertEqual(summarize(samples, "p50"), 1)
+        self.assertEqual(summarize(samples, "p95"), 2)
+        self.assertEqual(summarize(samples, "p100"), 4)
+
+    def test_timeframe(self):
+        self.assertEqual(timeframe(3600), ("hour", 60))
+        self.assertEqual(timeframe(24 * 3600), ("day", 1800))
+        self.assertEqual(timeframe(10 ** 9)[0], "year")
+
+    def proxmox(self, now, requests):
+        def rrddata(node, vmid, field):
+            def get(timeframe, cf):
+                requests.append((node, vmid, timeframe))
+                step = dict([("hour", 60), ("day", 1800)])[timeframe]
+                return [
+                    {"time": time, field: 2 if time % 7200 else 10}
+                    for time in range(now - 69 * step, now + 1, step)
+                ]
+            return get
+
+        return fake_api({
+            "nodes/a/rrddata": rrddata("a", None, "memused"),
+            "nodes/a/qemu/100/rrddata": rrddata("a", 100, "mem"),
+        })
+
+    def test_add_memory_history(self):
+        now = 100 * 24 * 3600
+        with TemporaryDirectory() as tmp:
+            cache = os.path.join(tmp, "cache", "rrd.json")
+            for offset, fetched in ((0, "day"), (600, "hour")):
+                hosts = [Host("a", 5, 16, [VM(100, 5, 8, "a")])]
+                requests = []
+                add_memory_history(
+                    self.proxmox(now + offset, requests),
+                    hosts, "p50", 24 * 3600, cache, now=now + offset,
+                )
+                # Later runs only fetch the samples added since
+                self.assertEqual(
+                    set(requests),
+                    {("a", None, fetched), ("a", 100, fetched)},
+                )
+                self.assertEqual(hosts[0].used_memory, 2)
+                self.assertEqual(hosts[0].vms, [VM(100, 2, 8, "a")])
+
+            hosts = [Host("a", 5, 16, [])]
+            add_memory_history(
+                self.proxmox(now, []), hosts, "p95", 24 * 3600, now=now,
+            )
+            self.assertEqual(hosts[0].used_memory, 10)
+
+            # VMs stored in columns are updated in place
+            table = VMTable()
+            hosts = [Host("a", 5, 16, [table.append(100, 5, 8, "a")])]
+            add_memory_history(
+                self.proxmox(now, []), hosts, "p50", 24 * 3600, now=now,
+            )
+            self.assertEqual(as_vms(table), [VM(100, 2, 8, "a")])
+            self.assertEqual(hosts[0].vms, list(table))
+
+
+class TestReplanner(unittest.TestCase):
+    GiB = 1024 ** 3
+
+    def vm(self, vmid, host):
+        return VM(vmid, 2 * self.GiB, 4 * self.GiB, host)
+
+    def replanner(self, nodes):
+        # The cluster as it is now, while the plan had all VMs on a
+        self.cluster = FakeCluster([
+            Host(name, len(vmids) * 2 * self.GiB, 16 * self.GiB,
+                 [self.vm(vmid, name) for vmid in vmids])
+            for name, vmids in nodes.items()
+        ])
+        hosts = [
+            Host("a", 6 * self.GiB, 16 * self.GiB,
+                 [self.vm(1, "a"), self.vm(2, "a"), self.vm(3, "a")]),
+            Host("b", 0, 16 * self.GiB, []),
+            Host("c", 0, 16 * self.GiB, []),
+        ]
+        return Replanner(
+            FakeProxmox(self.cluster.handle), hosts, [], calculate_migrations,
+        )
+
+    def test_no_drift(self):
+        replanner = self.replanner({"a": [2, 3], "b": [1], "c": []})
+        pending = [Migration(self.vm(2, "a"), "c")]
+        self.assertIs(
+            replanner([Migration(self.vm(1, "a"), "b")], [], pending),
+            pending,
+        )
+
+    def test_drift(self):
+        # VM 2 has been migrated to b by hand meanwhile
+        replanner = self.replanner({"a": [3], "b": [1, 2], "c": []})
+        self.assertEqual(
+            replanner(
+                [Migration(self.vm(1, "a"), "b")],
+                [],
+                [Migration(self.vm(2, "a"), "c")],
+            ),
+            [Migration(self.vm(1, "b"), "c")],
+        )
+
+    def test_failed(self):
+        replanner = self.replanner({"a": [1, 2, 3], "b": [], "c": []})
+        pending = [Migration(self.vm(3, "a"), "c")]
+        self.assertIs(
+            replanner(
+                [],
+                [Migration(self.vm(2, "a"), "b")],
+                pending,
+                [Migration(self.vm(1, "a"), "b")],
+            ),
+            pending,
+        )
+        # The busy hosts aren't refreshed, VM 1 is still expected on a
+        self.assertEqual(
+            [vm.id for vm in replanner.hosts["a"].vms], [1, 2, 3],
+        )
+        self.assertEqual(replanner.hosts["b"].vms, [])
+
+    def test_moved_by_hand(self):
+        replanner = self.replanner({"a": [1, 2, 3], "b": [2], "c": []})
+        # a is busy, so only b is refreshed
+        self.assertTrue(replanner.refresh({"b"}))
+        self.assertEqual([vm.id for vm in replanner.hosts["a"].vms], [1, 3])
+        self.assertEqual(replanner.hosts["a"].used_memory, 4 * self.GiB)
+        self.assertEqual(replanner.hosts["b"].used_memory, 2 * self.GiB)
+
+    def test_slow_drift(self):
+        replanner = self.replanner({"a": [1, 2, 3], "b": [], "c": []})
+        self.cluster.overhead["b"] = (0.75 * self.GiB, 0)
+        self.assertFalse(replanner.refresh({"b"}))
+        # Drift adds up until it exceeds the threshold
+        self.cluster.overhead["b"] = (1.5 * self.GiB, 0)
+        self.assertTrue(replanner.refresh({"b"}))
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_round_trip(self):
+        hosts, exclude = generate_cluster(8, 100, num_excluded=2, seed=1)
+        hosts[0].vms[0] = hosts[0].vms[0]._replace(cpu=1.5, local_disk=10)
+        with TemporaryDirectory() as tmp:
+            for name in ("cluster.jsonl", "cluster.jsonl.gz"):
+                path = os.path.join(tmp, name)
+                write_snapshot(path, hosts, exclude)
+                other_hosts, other_exclude = read_snapshot(path)
+                self.assertEqual(
+                    [host.name for host in other_exclude],
+                    [host.name for host in exclude],
+                )
+                self.assertEqual(
+                    [as_vms(host.vms) for host in other_hosts],
+                    [host.vms for host in hosts],
+                )
+                self.assertEqual(
+                    as_migrations(
+                        calculate_migrations(other_hosts, other_exclude),
+                    ),
+                    calculate_migrations(hosts, exclude),
+                )
+
+            result = run_snapshot("reference", path, repeat=1)
+            self.assertEqual(result["hosts"], 8)
+            self.assertEqual(result["vms"], 100)
+
+    def test_invalid(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cluster.jsonl")
+            with open(path, "w") as f:
+                f.write('{"host": "a"}\n')
+            with self.assertRaises(ValueError):
+                read_snapshot(path)
+
+
+@unittest.skipIf(which("openssl") is None, "openssl is not installed")
+class TestFakeApi(unittest.TestCase):
+    def test_balance(self):
+        hosts, _ = generate_cluster(4, 20, skew=1, seed=2)
+        cluster = FakeCluster(deepcopy(hosts), speedup=1000)
+        with FakeServer(cluster) as server, TemporaryDirectory() as tmp:
+            textfile = os.path.join(tmp, "pve_balance.prom")
+            balance(
+                {"host": server.host, "user": "root@pam", "password": "",
+                 "verify_ssl": False},
+                wait=True,
+                limits=MigrationLimits(None, None, None, None),
+                minimize="bytes",
+                metrics_textfile=textfile,
+            )
+            with open(textfile) as f:
+                metrics = f.read().splitlines()
+
+        migrations = cluster.requests[r"nodes/([^/]+)/qemu/(\d+)/migrate"]
+        self.assertEqual(migrations, len(calculate_migrations(hosts)))
+        self.assertGreater(migrations, 0)
+        self.assertIn(
+            "pve_balance_migrations {}".format(migrations), metrics,
+        )
+        self.assertIn(
+            'pve_balance_api_requests{{method="POST"}} {}'.format(migrations),
+            metrics,
+        )
+        self.assertIn("pve_balance_api_errors 0", metrics)
+        for host in hosts:
+            host.vms = cluster.node_vms(host.name)
+            host.used_memory = cluster.used_memory(host.name)
+        self.assertEqual(calculate_migrations(hosts), [])
+
+    def test_plan_cache(self):
+        hosts, _ = generate_cluster(4, 20, skew=1, seed=2)
+        cluster = FakeCluster(deepcopy(hosts), speedup=1000)
+        with FakeServer(cluster) as server, TemporaryDirectory() as tmp:
+            def run(**options):
+                textfile = os.path.join(tmp, "pve_balance.prom")
+                balance(
+                    {"host": server.host, "user": "root@pam",
+                     "password": "", "verify_ssl": False},
+                    limits=MigrationLimits(None, None, None, None),
+                    plan_cache=os.path.join(tmp, "plans.json"),
+                    metrics_textfile=textfile,
+                    **options
+                )
+                with open(textfile) as f:
+                    return 'phase="planning"' in f.read()
+
+            self.assertTrue(run(dry=True))
+            # The cluster didn't change, so the plan is reused and executed
+            with self.assertLogs("pve_balance.scheduler", "INFO") as logs:
+                self.assertFalse(run(wait=True))
+            self.assertIn("transferring an estimated", logs.output[0])
+            # Reusing the plan is saved for evicting
+            with open(os.path.join(tmp, "plans.json")) as f:
+                entries = json.load(f)["entries"]
+            self.assertTrue(any(
+                entry["used"] > entry["created"]
+                for entry in entries.values()
+            ))
+            migrate = r"nodes/([^/]+)/qemu/(\d+)/migrate"
+            migrations = cluster.requests[migrate]
+            self.assertGreater(migrations, 0)
+            # After the migrations, there's nothing to do, which is cached
+            self.assertTrue(run(wait=True))
+            self.assertFalse(run(wait=True))
+            self.assertEqual(cluster.requests[migrate], migrations)
+
+
+class TestPlanCache(unittest.TestCase):
+    GiB = 1024 ** 3
+
+    def hosts(self, memory=0):
+        return [
+            Host("a", 4 * self.GiB + memory, 16 * self.GiB, [
+                VM(1, 2 * self.GiB + memory, 4 * self.GiB, "a"),
+                VM(2, 2 * self.GiB, 4 * self.GiB, "a"),
+            ]),
+            Host("b", 0, 16 * self.GiB, []),
+        ]
+
+    def test_fingerprint(self):
+        hosts = self.hosts()
+        key = fingerprint(hosts, [], engine="reference")
+        self.assertEqual(
+            fingerprint(self.hosts(1024 ** 2)[::-1], [], engine="reference"),
+            key,
+        )
+        hosts[0].vms.reverse()
+        self.assertEqual(fingerprint(hosts, [], engine="reference"), key)
+
+        self.assertNotEqual(
+            fingerprint(self.hosts(self.GiB), [], engine="reference"), key,
+        )
+        self.assertNotEqual(fingerprint(hosts, hosts[:1]), key)
+        self.assertNotEqual(fingerprint(hosts, [], engine="numpy"), key)
+        self.assertNotEqual(
+            fingerprint(hosts, [], 2 * self.GiB, engine="reference"), key,
+        )
+        hosts[0].vms[1] = hosts[0].vms[1]._replace(local_disk=self.GiB)
+        self.assertNotEqual(fingerprint(hosts, [], engine="reference"), key)
+        hosts[0].vms.pop()
+        self.assertNotEqual(fingerprint(hosts, [], engine="reference"), key)
+
+    def test_cache(self):
+        hosts = self.hosts()
+        migrations = [Migration(hosts[0].vms[0], "b")]
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache", "plans.json")
+            cache = PlanCache(path, max_entries=2, max_age=60)
+            cache.put("x", migrations, now=0)
+            cache.put("y", [], now=10)
+            cache.save()
+
+            cache = PlanCache.load(path, max_entries=2, max_age=60)
+            self.assertEqual(cache.get("y", hosts, now=15), [])
+            self.assertEqual(cache.get("x", hosts, now=20), migrations)
+            self.assertIsNone(cache.get("z", hosts, now=20))
+            self.assertIsNone(cache.get("x", hosts[1:], now=20))
+            self.assertIsNone(cache.get("x", hosts, now=61))
+
+            # x was used more recently than y
+            cache.put("z", [], now=30)
+            self.assertEqual(set(cache.entries), {"x", "z"})
+            cache.evict(now=65)
+            self.assertEqual(set(cache.entries), {"z"})
+
+            # Files not holding a cache are ignored
+            with open(path, "w") as f:
+                json.dump([], f)
+            self.assertEqual(PlanCache.load(path).entries, {})
+
+
+class TestLocalSearch(unittest.TestCase):
+    GiB = 1024 ** 3
+
+    def hosts(self):
+        return [
+            Host("a", 40 * self.GiB, 64 * self.GiB, [
+                VM(1, 20 * self.GiB, 32 * self.GiB, "a"),
+                VM(2, 20 * self.GiB, 32 * self.GiB, "a"),
+            ]),
+            Host("b", 10 * self.GiB, 64 * self.GiB, [
+                VM(3, 10 * self.GiB, 16 * self.GiB, "b"),
+            ]),
+        ]
+
+    def test_improve(self):
+        hosts = self.hosts()
+        # Any VM of a overshoots b by more than the threshold
+        self.assertEqual(calculate_migrations(hosts), [])
+
+        stats = Counter()
+        migrations = improve_migrations(hosts, [], [], stats=stats)
+        self.assertEqual(migrations, [Migration(hosts[0].vms[0], "b")])
+        self.assertEqual(stats["exchanges_move"], 1)
+        self.assertEqual(max(map(load, hosts)), 5 * self.GiB)
+
+    def test_time_budget(self):
+        hosts = self.hosts()
+        self.assertEqual(improve_migrations(hosts, [], [], time_budget=0), [])
+
+    def test_cluster(self):
+        hosts, exclude = generate_cluster(
+            16, 500, "huge", skew=0.5, num_excluded=1,
+        )
+        migrations = calculate_migrations(hosts, exclude)
+        greedy_imbalance = max(map(load, hosts))
+        stats = Counter()
+        migrations = improve_migrations(
+            hosts, exclude, migrations, time_budget=0.5, stats=stats,
+        )
+        self.assertLess(max(map(load, hosts)), greedy_imbalance)
+        self.assertGreater(stats["exchanges_evaluated"], 0)
+
+        vms = [migration.vm.id for migration in migrations]
+        self.assertEqual(len(vms), len(set(vms)))
+        for migration in migrations:
+            self.assertNotEqual(migration.target_host, migration.vm.host)
+            self.assertNotIn(migration.target_host, {exclude[0].name})
+        for vm in exclude[0].vms:
+            self.assertIn(vm.id, vms)
+
+
+class TestCompact(unittest.TestCase):
+    GiB = 1024 ** 3
+
+    def hosts(self, memory=4):
+        return [
+            Host(name, 16 * self.GiB, 64 * self.GiB, [
+                VM(vmid, memory * self.GiB, 16 * self.GiB, name),
+            ])
+            for name, vmid, memory in (
+                ("a", 1, 8), ("b", 2, 8), ("c", 3, memory),
+            )
+        ]
+
+    def test_chain(self):
+        hosts = self.hosts(8)
+        a, b, c = (host.vms[0] for host in hosts)
+        stats = Counter()
+        migrations = compact_migrations(hosts, [], [
+            Migration(a, "b"), Migration(b, "c"), Migration(c, "a"),
+        ], stats=stats)
+        # a migrates to c directly, which cancels with c migrating to a
+        self.assertEqual(migrations, [])
+        self.assertEqual(stats["compacted_chains"], 1)
+        self.assertEqual(stats["compacted_cancellations"], 1)
+
+    def test_cancel(self):
+        hosts = self.hosts()
+        a, b, c = (host.vms[0] for host in hosts)
+        stats = Counter()
+        migrations = compact_migrations(hosts, [], [
+            Migration(a, "b"), Migration(c, "b"), Migration(b, "a"),
+        ], stats=stats)
+        self.assertEqual(migrations, [Migration(c, "b")])
+        self.assertEqual(stats["compacted_cancellations"], 1)
+
+        # VMs of excluded hosts still leave them
+        self.assertEqual(
+            compact_migrations(
+                hosts, [hosts[0]], [Migration(a, "b"), Migration(b, "c")],
+            ),
+            [Migration(a, "c")],
+        )
+
+    def test_tolerance(self):
+        hosts = self.hosts()
+        a, b, c = (host.vms[0] for host in hosts)
+        migrations = [Migration(a, "b"), Migration(b, "c")]
+        stats = Counter()
+        self.assertEqual(
+            compact_migrations(hosts, [], migrations, stats=stats),
+            [Migration(a, "c")],
+        )
+        self.assertEqual(stats["compacted_chains"], 1)
+
+        migrations = [Migration(a, "c"), Migration(c, "a")]
+        self.assertEqual(compact_migrations(hosts, [], migrations), migrations)
+        self.assertEqual(
+            compact_migrations(hosts, [], migrations, tolerance=4 * self.GiB),
+            [],
+        )
+
+    def test_duplicates(self):
+        hosts = self.hosts()
+        a, b, c = (host.vms[0] for host in hosts)
+        stats = Counter()
+        migrations = compact_migrations(hosts, [], [
+            Migration(a, "b"), Migration(c, "b"), Migration(a, "a"),
+        ], stats=stats)
+        self.assertEqual(migrations, [Migration(c, "b")])
+        self.assertEqual(stats["compacted_duplicates"], 2)
+
+    def test_calculate(self):
+        # Plans are only compacted with a tolerance
+        metrics = Metrics()
+        calculate(self.hosts(), [], metrics=metrics)
+        self.assertNotIn("compaction", metrics.phases)
+        calculate(self.hosts(), [], metrics=metrics, compact_tolerance=1)
+        self.assertIn("compaction", metrics.phases)
+
+
+class TestDrain(unittest.TestCase):
+    GiB = 1024 ** 3
+
+    def test_best_fit(self):
+        hosts = [
+            Host("a", 38 * self.GiB, 64 * self.GiB, [
+                VM(1, 4 * self.GiB, 8 * self.GiB, "a"),
+                VM(2, 24 * self.GiB, 32 * self.GiB, "a"),
+                VM(3, 10 * self.GiB, 16 * self.GiB, "a"),
+            ]),
+            Host("b", 30 * self.GiB, 64 * self.GiB, []),
+            Host("c", 26 * self.GiB, 64 * self.GiB, []),
+        ]
+        stats = Counter()
+        migrations = calculate_drain(hosts, [hosts[0]], stats=stats)
+        # The headrooms up to the average of 47 GiB are 18 GiB on b and
+        # 22 GiB on c, so the largest VM overshoots c with the most free
+        # memory, and the others fit b
+        self.assertEqual(migrations, [
+            Migration(hosts[0].vms[1], "c"),
+            Migration(hosts[0].vms[2], "b"),
+            Migration(hosts[0].vms[0], "b"),
+        ])
+        self.assertEqual(stats["rejected_target_overshoot"], 1)
+        self.assertEqual(stats["vms_left"], 0)
+
+    def test_left(self):
+        hosts = [
+            Host("a", 40 * self.GiB, 64 * self.GiB, [
+                VM(1, 40 * self.GiB, 48 * self.GiB, "a"),
+            ]),
+            Host("b", 32 * self.GiB, 64 * self.GiB, []),
+        ]
+        stats = Counter()
+        with self.assertLogs("pve_balance.algorithm", "WARNING") as logs:
+            migrations = calculate_drain(hosts, [hosts[0]], stats=stats)
+        self.assertIn("without fully emptying a", logs.output[-1])
+        self.assertEqual(migrations, [])
+        self.assertEqual(stats["vms_left"], 1)
+
+    def test_source_host(self):
+        # The VM's host field may be stale, the host it was listed by counts
+        hosts = [
+            Host("a", 8 * self.GiB, 64 * self.GiB, [
+                VM(1, 8 * self.GiB, 16 * self.GiB, "x"),
+            ]),
+            Host("b", 0, 64 * self.GiB, []),
+        ]
+        migrations = calculate_drain(hosts, [hosts[0]])
+        self.assertEqual(migrations, [Migration(hosts[0].vms[0], "b")])
+        self.assertEqual(hosts[0].memory_imbalance, 0)
+        self.assertEqual(hosts[1].memory_imbalance, 0)
+
+    def test_cluster(self):
+        hosts, exclude = generate_cluster(
+            16, 2000, "heavy-tailed", skew=0.5, num_excluded=2,
+        )
+        migrations = calculate_drain(hosts, exclude)
+        planned = {migration.vm for migration in migrations}
+        self.assertEqual(
+            planned, {vm for host in exclude for vm in host.vms},
+        )
+        for migration in migrations:
+            self.assertNotIn(
+                migration.target_host, {host.name for host in exclude},
+            )
+
+
+class TestSweep(unittest.TestCase):
+    GiB = 1024 ** 3
+
+    def test_remaining_imbalance(self):
+        hosts, exclude = generate_cluster(8, 200, skew=1, num_excluded=1)
+        migrations = calculate_migrations(hosts, exclude)
+        self.assertAlmostEqual(
+            remaining_imbalance(hosts, exclude, migrations),
+            max(abs(host.memory_imbalance) for host in hosts),
+            delta=1,
+        )
+
+    def test_sweep(self):
+        hosts, exclude = generate_cluster(8, 200, skew=1)
+        variants = make_variants(
+            [self.GiB, 4 * self.GiB], ["reference"], [(), ("node0001",)],
+        )
+        self.assertEqual(len(variants), 4)
+
+        results = sweep_variants(hosts, exclude, variants, workers=2)
+        self.assertEqual(
+            [(result["threshold"], result["drain"]) for result in results],
+            [
+                (self.GiB, []),
+                (self.GiB, ["node0001"]),
+                (4 * self.GiB, []),
+                (4 * self.GiB, ["node0001"]),
+            ],
+        )
+        self.assertLessEqual(results[0]["remaining_imbalance"], self.GiB)
+        self.assertGreater(results[1]["migrations"], results[0]["migrations"])
+        self.assertLessEqual(
+            results[2]["migrations"], results[0]["migrations"],
+        )
+        for result in results:
+            self.assertGreater(result["bytes"], 0)
+            self.assertGreater(result["duration"], 0)
+
+        lines = format_results(results).splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertIn("node0001", lines[2])
+
+
+class TestByteFormatter(unittest.TestCase):
+    def test_format(self):
+        formatter = ByteFormatter()
+        self.assertEqual(
+            formatter.format("{!b} {:>3} {!b}", 1023, 7, 5 * 1024 ** 3),
+            "1023 B   7 5.00 GB",
+        )
+        self.assertEqual(formatter.format("{!b:>9}|", 2048), "  2.00 KB|")
+
+    def test_threads(self):
+        formatter = ByteFormatter()
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(
+                lambda i: formatter.format("{} {!b}", i, i * 1024),
+                range(2000),
+            ))
+        self.assertEqual(results, [
+            "{} {:.2f} KB".format(i, i) if 0 < i < 1024
+            else "{} {:.2f} MB".format(i, i / 1024) if i else "0 0 B"
+            for i in range(2000)
+        ])
@@ -0,0 +1,321 @@
+"""
+Planning engine holding the VMs of the cluster in NumPy arrays.
+
+It follows the same strategy as :func:`pve_balance.algorithm.
+calculate_migrations` and yields the same migrations. Balancing CPU or
+minimizing a cost, it evaluates all VMs of a source host against a target
+host in a single vectorized step. Balancing memory only, the closest VM is
+found by bisecting the host's VMs, skipping the ones already planned. That
+is what the reference engine does as well, so this engine is no faster
+there: the time goes to the Python loop over migrations, which NumPy can't
+batch, as each migration depends on the previous ones.
+"""
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from operator import attrgetter
+import logging
+
+import numpy as np
+
+from .algorithm import (
+    TRACE_PAIR,
+    TRACE_PLAN,
+    TRACE_REMAINING,
+    HostQueue,
+    host_pairs,
+    max_imbalance,
+    set_cpu_imbalance,
+    set_memory_imbalance,
+    shift_imbalance,
+    warn_remaining_vms,
+)
+from .helper import Trace, get_logger
+from .model import Migration
+
+logger = get_logger(__name__)
+
+
+def vm_column(vms, field):
+    """
+    Returns the named field of the VMs as an array. If all VMs are views of
+    the same :class:`pve_balance.model.VMTable`, the values are taken from
+    its column at once.
+    """
+    try:
+        tables = set(map(attrgetter("table"), vms))
+    except AttributeError:
+        tables = None
+    if tables and len(tables) == 1:
+        indexes = np.fromiter(
+            map(attrgetter("index"), vms), dtype=np.intp, count=len(vms),
+        )
+        column = np.asarray(getattr(tables.pop(), field))
+        return column[indexes].astype(np.float64)
+
+    return np.fromiter(
+        map(attrgetter(field), vms), dtype=np.float64, count=len(vms),
+    )
+
+
+def find(links, i):
+    """
+    Follows the links from index `i` to an index linking to itself, and
+    shortens the path taken to point there directly
+    """
+    root = i
+    while links[root] != root:
+        root = links[root]
+    while links[i] != root:
+        links[i], i = root, links[i]
+    return root
+
+
+def calculate_migrations(hosts, exclude=[], threshold=1024**3, stats=None,
+                         cost=None, cpu_weight=0, trace=None):
+    if stats is None:
+        stats = Counter()
+
+    log_trace = trace is None and logger.isEnabledFor(logging.DEBUG)
+    if log_trace:
+        trace = Trace()
+
+    planned = {}
+
+    if not hosts:
+        return []
+
+    hosts = list(hosts)
+    exclude = set(exclude)
+
+    target_ratio = set_memory_imbalance(hosts, exclude)
+    cpu_factor = set_cpu_imbalance(hosts, exclude, cpu_weight)
+    index = {host: i for i, host in enumerate(hosts)}
+
+    # VMs of each host are stored consecutively, sorted by used memory. VMs
+    # without used memory won't change anything, so skip them early.
+    vms = []
+    bounds = [0]
+    used = []
+    cpu_load = []
+    for host in hosts:
+        host_vms = list(host.vms)
+        host_used = vm_column(host_vms, "used_memory")
+        # A stable sort keeps VMs with equal memory in their original order
+        order = np.argsort(host_used, kind="stable")
+        order = order[host_used[order] != 0]
+        vms.extend(map(host_vms.__getitem__, order.tolist()))
+        bounds.append(len(vms))
+        used.append(host_used[order])
+        cpu_load.append(vm_column(host_vms, "cpu")[order])
+    used = np.concatenate(used)
+    cpu_load = cpu_factor * np.concatenate(cpu_load)
+    if cost is not None:
+        vm_cost = np.array([cost(vm) for vm in vms], dtype=np.float64)
+    available = np.ones(len(vms), dtype=bool)
+
+    # Links to the next and, shifted by one, the previous VM not planned yet
+    used_list = used.tolist()
+    next_available = list(range(len(vms) + 1))
+    previous_available = list(range(len(vms) + 1))
+
+    # The hosts are ordered like in the reference engine
+    donors = HostQueue(hosts)
+    receivers = HostQueue(hosts, descending=True)
+
+    def remaining_imbalance():
+        if cpu_factor:
+            return max(
+                max(abs(host.memory_imbalance), abs(host.cpu_imbalance))
+                for host in hosts
+            )
+        return max_imbalance(donors, receivers)
+
+    def closest_vm(source_host, target_host):
+        """
+        Returns the index of the available VM of the source host bringing it
+        closest to its target ratio without overshooting it or the target
+        host's by more than the threshold, or None if there is none. In case
+        of a tie, VMs with less memory and then earlier ones are preferred.
+        """
+        source = index[source_host]
+        start, end = bounds[source], bounds[source + 1]
+        memory = -source_host.memory_imbalance
+        limit = memory + threshold
+        if source_host not in exclude:
+            limit = min(limit, target_host.memory_imbalance + threshold)
+        end = bisect_right(used_list, limit, start, end)
+        position = bisect_left(used_list, memory, start, end)
+
+        right = find(next_available, position)
+        left = find(previous_available, position) - 1
+        if left >= start:
+            # The first available VM of equal memory
+            left = find(
+                next_available,
+                bisect_left(used_list, used_list[left], start, left),
+            )
+        if right < end and (
+            left < start
+            or used_list[right] - memory < memory - used_list[left]
+        ):
+            return right
+        if left >= start:
+            return left
+        return None
+
+    def best_vm(source_host, target_host):
+        """
+        Returns the index of the VM to migrate from source to target host,
+        or None if no VM fits
+        """
+        if not cpu_factor and cost is None:
+            i = closest_vm(source_host, target_host)
+            if i is not None:
+                stats["vms_evaluated"] += 1
+            return i
+
+        source = index[source_host]
+        start, end = bounds[source], bounds[source + 1]
+        vm_used = used[start:end]
+        source_memory = source_host.memory_imbalance
+        target_memory = target_host.memory_imbalance
+
+        candidates = available[start:end]
+        stats["vms_evaluated"] += int(np.count_nonzero(candidates))
+        if source_host not in exclude:
+            fits = vm_used <= target_memory + threshold
+            stats["rejected_target_overshoot"] += int(
+                np.count_nonzero(candidates & ~fits)
+            )
+            candidates = candidates & fits
+
+        if cpu_factor:
+            # Score all VMs at once by the change of the summed absolute
+            # imbalance of both hosts in all dimensions
+            vm_cpu = cpu_load[start:end]
+            source_cpu = source_host.cpu_imbalance
+            target_cpu = target_host.cpu_imbalance
+            change = (
+                np.abs(source_memory + vm_used)
+                - abs(source_memory)
+                + np.abs(source_cpu + vm_cpu)
+                - abs(source_cpu)
+                + np.abs(target_memory - vm_used)
+                - abs(target_memory)
+                + np.abs(target_cpu - vm_cpu)
+                - abs(target_cpu)
+            )
+            if source_host not in exclude:
+                improves = change < 0
+                stats["rejected_no_improvement"] += int(
+                    np.count_nonzero(candidates & ~improves)
+                )
+                candidates = candidates & improves
+            if not candidates.any():
+                return None
+
+            score = np.where(candidates, change, np.inf)
+            if cost is None:
+                return start + score.argmin()
+
+            # Prefer the largest improvement per transferred byte
+            key = np.where(candidates, change / vm_cost[start:end], np.inf)
+            return start + np.lexsort((score, key))[0]
+
+        # Don't overshoot the target ratio of the source host
+        candidates = candidates & (vm_used <= -source_memory + threshold)
+        if not candidates.any():
+            return None
+
+        # Prefer migrating VMs that bring the source host closest to the
+        # target ratio. As VMs are sorted by used memory, argmin() prefers
+        # VMs with little memory in case of a tie.
+        score = np.where(
+            candidates,
+            np.abs(vm_used + source_memory),
+            np.inf,
+        )
+
+        # Prefer the cheapest VM bringing the source host within the
+        # threshold, then the VM with the least cost per byte of memory
+        preferred = score <= threshold
+        if preferred.any():
+            key = np.where(preferred, vm_cost[start:end], np.inf)
+        else:
+            key = np.where(
+                candidates,
+                vm_cost[start:end] / vm_used,
+                np.inf,
+            )
+        return start + np.lexsort((score, key))[0]
+
+    def next_migration():
+        """
+        Migrate from the most over-loaded to the most under-loaded host.
+        Returns the source host, target host and index of the VM or None
+        """
+        pairs = host_pairs(donors, receivers, exclude, signed=not cpu_factor)
+        for source_host, target_host in pairs:
+            stats["host_pairs"] += 1
+            if trace is not None:
+                trace.add(TRACE_PAIR, source_host.name, target_host.name)
+            i = best_vm(source_host, target_host)
+            if i is not None:
+                pairs.close()
+                return source_host, target_host, i
+
+        return None
+
+    logger.info(
+        "Target memory ratio is {:.0%}, starting imbalance is {!b}",
+        target_ratio,
+        remaining_imbalance(),
+    )
+
+    while remaining_imbalance() > threshold:
+        stats["iterations"] += 1
+        if trace is not None:
+            trace.add(TRACE_REMAINING, remaining_imbalance())
+        migration = next_migration()
+        if migration is None:
+            # No VM fits between any over-loaded and under-loaded host
+            break
+
+        source_host, target_host, i = migration
+        vm = vms[i]
+        if vm.used_memory > target_host.memory_imbalance + threshold:
+            logger.info(
+                "Migrating VM {0.id} from host {1.name} to host {2.name} "
+                "despite overshooting memory imbalance by {3!b}, because we "
+                "need to empty {1.name}",
+                vm, source_host, target_host,
+                vm.used_memory - target_host.memory_imbalance,
+            )
+        logger.info(
+            "Planning migration of VM {0.id} (memory={0.used_memory!b}) from "
+            "host {1.name} to host {2.name}",
+            vm,
+            source_host,
+            target_host,
+        )
+        if trace is not None:
+            trace.add(TRACE_PLAN, vm.id, target_host.name)
+        planned[vm] = target_host.name
+        available[i] = False
+        next_available[i] = i + 1
+        previous_available[i + 1] = i
+        shift_imbalance(vm, source_host, target_host, cpu_factor)
+
+        for host in (source_host, target_host):
+            donors.push(host)
+            receivers.push(host)
+
+    if log_trace:
+        logger.debug("Planning steps:\n{}", trace)
+    logger.info(
+        "Terminating with a remaining imbalance of {!b}",
+        remaining_imbalance(),
+    )
+    warn_remaining_vms(exclude, planned)
+
+    return [Migration(vm, target) for vm, target in planned.items()]